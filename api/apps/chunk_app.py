@@ -106,7 +106,7 @@ def get():
         res["chunk_id"] = id
         k = []
         for n in res.keys():
-            if re.search(r"(_vec$|_sm_|_tks|_ltks)", n):
+            if re.search(r"(_vec$|_sm_|_tks|_ltks|_tw_)", n):
                 k.append(n)
         for n in k:
             del res[n]
@@ -159,6 +159,7 @@ def set():
             q, a = rmPrefix(arr[0]), rmPrefix(arr[1])
             d = beAdoc(d, arr[0], arr[1], not any(
                 [rag_tokenizer.is_chinese(t) for t in q + a]))
+        d["content_terms"] = retrievaler.content_terms(d["content_ltks"])
 
         v, c = embd_mdl.encode([doc.name, req["content_with_weight"]])
         v = 0.1 * v[0] + 0.9 * v[1] if doc.parser_id != ParserType.QA else v[1]
@@ -217,6 +218,7 @@ def create():
     d = {"id": chunck_id, "content_ltks": rag_tokenizer.tokenize(req["content_with_weight"]),
          "content_with_weight": req["content_with_weight"]}
     d["content_sm_ltks"] = rag_tokenizer.fine_grained_tokenize(d["content_ltks"])
+    d["content_terms"] = retrievaler.content_terms(d["content_ltks"])
     d["important_kwd"] = req.get("important_kwd", [])
     d["important_tks"] = rag_tokenizer.tokenize(" ".join(req.get("important_kwd", [])))
     d["create_time"] = str(datetime.datetime.now()).replace("T", " ")[:19]
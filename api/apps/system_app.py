@@ -26,6 +26,8 @@ from rag.utils.storage_factory import STORAGE_IMPL
 from timeit import default_timer as timer
 
 from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.embedding_cache import QueryEmbeddingCache
+from api.settings import retrievaler
 
 
 @manager.route('/version', methods=['GET'])
@@ -86,4 +88,7 @@ def status():
     except Exception as e:
         res["task_executor"] = {"status": "red", "error": str(e)}
 
+    res["query_embedding_cache"] = QueryEmbeddingCache().stats()
+    res["query_analysis_cache"] = retrievaler.qryr.stats()
+
     return get_json_result(data=res)
@@ -757,6 +757,7 @@ class Document(DataBaseModel):
         default="")
     process_begin_at = DateTimeField(null=True, index=True)
     process_duation = FloatField(default=0)
+    row_num = IntegerField(default=0, help_text="rows of a spreadsheet/csv, counted at upload")
 
     run = CharField(
         max_length=1,
@@ -1052,4 +1053,11 @@ def migrate_db():
             )
         except Exception as e:
             pass
+        try:
+            migrate(
+                migrator.add_column('document', 'row_num',
+                                    IntegerField(default=0, help_text="rows of a spreadsheet/csv, counted at upload"))
+            )
+        except Exception as e:
+            pass
 
@@ -27,6 +27,7 @@ from api.db.services.document_service import DocumentService
 from api.db.services.file2document_service import File2DocumentService
 from api.utils import get_uuid
 from api.utils.file_utils import filename_type, thumbnail
+from deepdoc.parser.excel_parser import RAGFlowExcelParser
 from rag.utils.storage_factory import STORAGE_IMPL
 
 
@@ -366,6 +367,12 @@ class FileService(CommonService):
                     "size": len(blob),
                     "thumbnail": thumbnail(filename, blob)
                 }
+                if re.search(r"\.(xlsx?|csv|txt)$", filename, re.IGNORECASE):
+                    # spares table parsing tasks from opening the file just to split it
+                    try:
+                        doc["row_num"] = RAGFlowExcelParser.row_number(filename, blob) or 0
+                    except Exception as e:
+                        pass
                 if doc["type"] == FileType.VISUAL:
                     doc["parser_id"] = ParserType.PICTURE.value
                 if doc["type"] == FileType.AURAL:
@@ -13,8 +13,12 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import numpy as np
+
 from api.db.services.user_service import TenantService
 from api.settings import database_logger
+from rag import settings as rag_settings
+from rag.utils.embedding_cache import EmbeddingCache, QueryEmbeddingCache
 from rag.llm import EmbeddingModel, CvModel, ChatModel, RerankModel, Seq2txtModel, TTSModel
 from api.db import LLMType
 from api.db.db_models import DB, UserTenant
@@ -194,9 +198,38 @@ class LLMBundle(object):
         for lm in LLMService.query(llm_name=llm_name):
             self.max_length = lm.max_tokens
             break
-    
+        self.cache_nm = self._cache_name()
+
+    def _cache_name(self):
+        """
+        What cached embeddings are keyed by. Compatible endpoints (LocalAI, Ollama,
+        Xinference, ...) may serve different models under one name, so the
+        endpoint, and the tenant that configured it, are part of the name.
+        """
+        if self.llm_type != LLMType.EMBEDDING or not self.llm_name:
+            return ""
+        nm = [self.mdl.__class__.__name__, self.llm_name]
+        cfg = TenantLLMService.get_api_key(self.tenant_id, self.llm_name)
+        if cfg and cfg.api_base:
+            nm.extend([cfg.llm_factory, cfg.api_base, self.tenant_id])
+        return "/".join(nm)
+
     def encode(self, texts: list, batch_size=32):
-        emd, used_tokens = self.mdl.encode(texts, batch_size)
+        if not self.cache_nm or not rag_settings.EMBEDDING_CACHE_ENABLED:
+            emd, used_tokens = self.mdl.encode(texts, batch_size)
+        else:
+            # Only texts never embedded by this model before are sent (and billed).
+            cache = EmbeddingCache()
+            cache_nm = self.cache_nm
+            emd = cache.get(cache_nm, texts)
+            miss = [i for i, v in enumerate(emd) if v is None]
+            used_tokens = 0
+            if miss:
+                vts, used_tokens = self.mdl.encode([texts[i] for i in miss], batch_size)
+                cache.put(cache_nm, [texts[i] for i in miss], vts)
+                for j, i in enumerate(miss):
+                    emd[i] = vts[j]
+            emd = np.array(emd)
         if not TenantLLMService.increase_usage(
                 self.tenant_id, self.llm_type, used_tokens):
             database_logger.error(
@@ -204,7 +237,14 @@ class LLMBundle(object):
         return emd, used_tokens
 
     def encode_queries(self, query: str):
+        cache_nm = self.cache_nm
+        if cache_nm:
+            emd = QueryEmbeddingCache().get(cache_nm, query)
+            if emd is not None:
+                return emd, 0
         emd, used_tokens = self.mdl.encode_queries(query)
+        if cache_nm:
+            QueryEmbeddingCache().put(cache_nm, query, emd)
         if not TenantLLMService.increase_usage(
                 self.tenant_id, self.llm_type, used_tokens):
             database_logger.error(
@@ -141,6 +141,7 @@ def queue_tasks(doc, bucket, name):
             "doc_id": doc["id"]
         }
     tsks = []
+    byte_ranges = {}
 
     if doc["type"] == FileType.PDF.value:
         file_bin = STORAGE_IMPL.get(bucket, name)
@@ -169,14 +170,25 @@ def queue_tasks(doc, bucket, name):
                 tsks.append(task)
 
     elif doc["parser_id"] == "table":
-        file_bin = STORAGE_IMPL.get(bucket, name)
-        rn = RAGFlowExcelParser.row_number(
-            doc["name"], file_bin)
+        rn = doc.get("row_num")
+        is_text = doc["name"].split(".")[-1].lower() in ["csv", "txt"]
+        file_bin = STORAGE_IMPL.get(bucket, name) if is_text or not rn else None
+        if not rn:
+            rn = RAGFlowExcelParser.row_number(
+                doc["name"], file_bin)
+            if rn:
+                DocumentService.update_by_id(doc["id"], {"row_num": rn})
+        # csv/txt tasks get where their rows are, so they don't parse the whole file
+        offsets = RAGFlowExcelParser.row_offsets(doc["name"], file_bin, 3000) if is_text else None
+        offsets = offsets or []
         for i in range(0, rn, 3000):
             task = new_task()
             task["from_page"] = i
             task["to_page"] = min(i + 3000, rn)
             tsks.append(task)
+            j = i // 3000
+            if j < len(offsets):
+                byte_ranges[task["id"]] = (offsets[j], offsets[j + 1] if j + 1 < len(offsets) else len(file_bin))
     else:
         tsks.append(new_task())
 
@@ -184,4 +196,6 @@ def queue_tasks(doc, bucket, name):
     DocumentService.begin2parse(doc["id"])
 
     for t in tsks:
+        if t["id"] in byte_ranges:
+            t["byte_range"] = byte_ranges[t["id"]]
         assert REDIS_CONN.queue_product(SVR_QUEUE_NAME, message=t), "Can't access Redis. Please check the Redis' status."
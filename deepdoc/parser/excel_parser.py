@@ -14,57 +14,88 @@
 from openpyxl import load_workbook
 import sys
 from io import BytesIO
+from itertools import islice
+
+import numpy as np
 
 from rag.nlp import find_codec
 
 
 class RAGFlowExcelParser:
-    def html(self, fnm, chunk_rows=256):
+    @staticmethod
+    def open_workbook(fnm):
+        """Read-only, so rows are parsed from the file as they are iterated rather than all kept in memory."""
         if isinstance(fnm, str):
-            wb = load_workbook(fnm)
-        else:
-            wb = load_workbook(BytesIO(fnm))
+            return load_workbook(fnm, read_only=True)
+        return load_workbook(BytesIO(fnm), read_only=True)
+
+    @staticmethod
+    def sheet_rows(ws, max_col=None):
+        """
+        Rows of a read-only sheet up to where it actually ends: the dimension
+        stored in the file may be stale, too small or too large.
+        """
+        ws.reset_dimensions()
+        return ws.iter_rows(max_col=max_col)
+
+    @staticmethod
+    def sheet_size(ws):
+        """(rows, columns) of a read-only sheet, counted by going through it."""
+        ws.reset_dimensions()
+        n, m = 0, 0
+        for i, r in enumerate(ws.iter_rows(values_only=True)):
+            if r:
+                n, m = i + 1, max(m, len(r))
+        return n, m
+
+    def html(self, fnm, chunk_rows=256):
+        wb = self.open_workbook(fnm)
 
         tb_chunks = []
         for sheetname in wb.sheetnames:
             ws = wb[sheetname]
-            rows = list(ws.rows)
-            if not rows: continue
+            rows = self.sheet_rows(ws)
+            header = next(rows, None)
+            if not header: continue
 
             tb_rows_0 = "<tr>"
-            for t in list(rows[0]):
+            for t in header:
                 tb_rows_0 += f"<th>{t.value}</th>"
             tb_rows_0 += "</tr>"
 
-            for chunk_i in range((len(rows) - 1) // chunk_rows + 1):
+            chunk = list(islice(rows, chunk_rows))
+            while True:
                 tb = ""
                 tb += f"<table><caption>{sheetname}</caption>"
                 tb += tb_rows_0
-                for r in list(rows[1 + chunk_i * chunk_rows:1 + (chunk_i + 1) * chunk_rows]):
+                for r in chunk:
                     tb += "<tr>"
                     for i, c in enumerate(r):
                         if c.value is None:
                             tb += "<td></td>"
                         else:
                             tb += f"<td>{c.value}</td>"
+                    # rows come as long as their last cell, pad them to the header
+                    tb += "<td></td>" * (len(header) - len(r))
                     tb += "</tr>"
                 tb += "</table>\n"
                 tb_chunks.append(tb)
+                chunk = list(islice(rows, chunk_rows))
+                if not chunk:
+                    break
 
+        wb.close()
         return tb_chunks
 
     def __call__(self, fnm):
-        if isinstance(fnm, str):
-            wb = load_workbook(fnm)
-        else:
-            wb = load_workbook(BytesIO(fnm))
+        wb = self.open_workbook(fnm)
         res = []
         for sheetname in wb.sheetnames:
             ws = wb[sheetname]
-            rows = list(ws.rows)
-            if not rows:continue
-            ti = list(rows[0])
-            for r in list(rows[1:]):
+            rows = self.sheet_rows(ws)
+            ti = next(rows, None)
+            if not ti:continue
+            for r in rows:
                 l = []
                 for i, c in enumerate(r):
                     if not c.value:
@@ -76,23 +107,47 @@ class RAGFlowExcelParser:
                 if sheetname.lower().find("sheet") < 0:
                     l += " ——" + sheetname
                 res.append(l)
+        wb.close()
         return res
 
     @staticmethod
     def row_number(fnm, binary):
         if fnm.split(".")[-1].lower().find("xls") >= 0:
-            wb = load_workbook(BytesIO(binary))
+            wb = RAGFlowExcelParser.open_workbook(binary)
             total = 0
             for sheetname in wb.sheetnames:
-                ws = wb[sheetname]
-                total += len(list(ws.rows))
-                return total
+                total += RAGFlowExcelParser.sheet_size(wb[sheetname])[0]
+            wb.close()
+            return total
 
         if fnm.split(".")[-1].lower() in ["csv", "txt"]:
             encoding = find_codec(binary)
+            if "\n".encode(encoding) == b"\n":
+                return binary.count(b"\n") + 1
             txt = binary.decode(encoding, errors="ignore")
             return len(txt.split("\n"))
 
+    @staticmethod
+    def row_offsets(fnm, binary, step, block=64 * 1024 * 1024):
+        """
+        Byte offsets where the data lines 0, step, 2*step... (the header line
+        excluded) of a csv/txt file start, found without decoding the file.
+        None if it isn't one, or its encoding can't be split on b"\\n".
+        """
+        if fnm.split(".")[-1].lower() not in ["csv", "txt"]:
+            return
+        if "\n".encode(find_codec(binary)) != b"\n":
+            return
+        offsets, n = [], 0
+        for base in range(0, len(binary), block):
+            nl = np.flatnonzero(np.frombuffer(binary, dtype=np.uint8, offset=base,
+                                              count=min(block, len(binary) - base)) == 10)
+            # the newline number k ends data line k - 1, the next one starts after it
+            sel = (np.arange(n, n + len(nl)) % step) == 0
+            offsets.extend((nl[sel] + base + 1).tolist())
+            n += len(nl)
+        return offsets
+
 
 if __name__ == "__main__":
     psr = RAGFlowExcelParser()
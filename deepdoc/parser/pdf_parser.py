@@ -11,8 +11,15 @@
 #  limitations under the License.
 #
 
+import multiprocessing
 import os
 import random
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 import xgboost as xgb
 from io import BytesIO
@@ -28,6 +35,7 @@ from pypdf import PdfReader as pdf2_read
 from api.utils.file_utils import get_project_base_directory
 from deepdoc.vision import OCR, Recognizer, LayoutRecognizer, TableStructureRecognizer
 from rag.nlp import rag_tokenizer
+from rag.settings import PDF_PARSER_WORKERS, PDF_PARSER_PARALLEL_PAGES, PDF_PAGE_CACHE_SIZE
 from copy import deepcopy
 from huggingface_hub import snapshot_download
 
@@ -38,9 +46,10 @@ class RAGFlowPdfParser:
     def __init__(self):
         self.ocr = OCR()
         if hasattr(self, "model_speciess"):
-            self.layouter = LayoutRecognizer("layout." + self.model_speciess)
+            self.layout_domain = "layout." + self.model_speciess
         else:
-            self.layouter = LayoutRecognizer("layout")
+            self.layout_domain = "layout"
+        self.layouter = LayoutRecognizer(self.layout_domain)
         self.tbl_det = TableStructureRecognizer()
 
         self.updown_cnt_mdl = xgb.Booster()
@@ -273,7 +282,8 @@ class RAGFlowPdfParser:
                 b["SP"] = ii
 
     def __ocr(self, pagenum, img, chars, ZM=3):
-        bxs = self.ocr.detect(np.array(img))
+        img = np.array(img)
+        bxs = self.ocr.detect(img)
         if not bxs:
             self.boxes.append([])
             return
@@ -304,13 +314,15 @@ class RAGFlowPdfParser:
             else:
                 bxs[ii]["text"] += c["text"]
 
+        # boxes without pdf chars are recognized together
+        unmatched = [b for b in bxs if not b["text"]]
+        texts = self.ocr.recognize_batch(img, [
+            np.array([[b["x0"] * ZM, b["top"] * ZM], [b["x1"] * ZM, b["top"] * ZM],
+                      [b["x1"] * ZM, b["bottom"] * ZM], [b["x0"] * ZM, b["bottom"] * ZM]], dtype=np.float32)
+            for b in unmatched])
+        for b, t in zip(unmatched, texts):
+            b["text"] = t
         for b in bxs:
-            if not b["text"]:
-                left, right, top, bott = b["x0"] * ZM, b["x1"] * \
-                                         ZM, b["top"] * ZM, b["bottom"] * ZM
-                b["text"] = self.ocr.recognize(np.array(img),
-                                               np.array([[left, top], [right, top], [right, bott], [left, bott]],
-                                                        dtype=np.float32))
             del b["txt"]
         bxs = [b for b in bxs if b["text"]]
         if self.mean_height[-1] == 0:
@@ -321,7 +333,7 @@ class RAGFlowPdfParser:
     def _layouts_rec(self, ZM, drop=True):
         assert len(self.page_images) == len(self.boxes)
         self.boxes, self.page_layout = self.layouter(
-            self.page_images, self.boxes, ZM, drop=drop)
+            self.page_images, self.boxes, ZM, drop=drop, layouts=self.layout_dets)
         # cumlative Y
         for i in range(len(self.boxes)):
             self.boxes[i]["top"] += \
@@ -936,6 +948,78 @@ class RAGFlowPdfParser:
         except Exception as e:
             logging.error(str(e))
 
+    def _page_chars(self, page):
+        return [{**c, 'top': c['top'], 'bottom': c['bottom']} for c in page.dedupe_chars().chars if self._has_color(c)]
+
+    def _ocr_page(self, i, img, zoomin):
+        chars = self.page_chars[i] if not self.is_english else []
+        self.mean_height.append(
+            np.median(sorted([c["height"] for c in chars])) if chars else 0
+        )
+        self.mean_width.append(
+            np.median(sorted([c["width"] for c in chars])) if chars else 8
+        )
+        self.page_cum_height.append(img.size[1] / zoomin)
+        j = 0
+        while j + 1 < len(chars):
+            if chars[j]["text"] and chars[j + 1]["text"] \
+                    and re.match(r"[0-9a-zA-Z,.:;!%]+", chars[j]["text"] + chars[j + 1]["text"]) \
+                    and chars[j + 1]["x0"] - chars[j]["x1"] >= min(chars[j + 1]["width"],
+                                                                   chars[j]["width"]) / 2:
+                chars[j]["text"] += " "
+            j += 1
+
+        self.__ocr(i + 1, img, chars, zoomin)
+
+    def _ocr_pages_parallel(self, pool, fnm, zoomin, page_from, callback=None):
+        """
+        OCR and layout detection of the pages by the page workers, a few pages
+        per job; the results are merged in page order as if done in turn.
+        Returns False if a worker failed, for the pages to be parsed in turn.
+        """
+        n = len(self.page_images)
+        step = max(1, -(-n // (PDF_PARSER_WORKERS * 2)))
+        jobs = []
+        # the workers read the PDF from a file rather than getting it with every job
+        with nullcontext() if isinstance(fnm, str) else tempfile.NamedTemporaryFile(suffix=".pdf") as tmp:
+            if tmp:
+                tmp.write(fnm)
+                tmp.flush()
+                fnm = tmp.name
+            try:
+                try:
+                    for s in range(0, n, step):
+                        jobs.append(pool.submit(_parse_pages, fnm, zoomin, page_from, s, min(s + step, n),
+                                                self.is_english, self.layout_domain))
+                except BrokenProcessPool as e:
+                    logging.warning("PDF page workers broke, pages are parsed in turn: " + str(e))
+                    reset_pool()
+                    return False
+                self.layout_dets = []
+                for s, job in zip(range(0, n, step), jobs):
+                    try:
+                        r = job.result()
+                    except Exception as e:
+                        logging.warning("PDF page worker failed, pages are parsed in turn: " + str(e))
+                        if isinstance(e, BrokenProcessPool):
+                            reset_pool()
+                        return False
+                    self.boxes.extend(r["boxes"])
+                    self.mean_height.extend(r["mean_height"])
+                    self.mean_width.extend(r["mean_width"])
+                    self.page_cum_height.extend(r["page_cum_height"])
+                    self.lefted_chars.extend(r["lefted_chars"])
+                    self.layout_dets.extend(r["layout_dets"])
+                    for i, size in enumerate(r["sizes"]):
+                        self.page_images.set_size(s + i, size)
+                    if callback:
+                        callback(prog=min(s + step, n) * 0.6 / n, msg="")
+                return True
+            finally:
+                # e.g. when the task got canceled by the callback
+                for job in jobs:
+                    job.cancel()
+
     def __images__(self, fnm, zoomin=3, page_from=0,
                    page_to=299, callback=None):
         self.lefted_chars = []
@@ -945,15 +1029,14 @@ class RAGFlowPdfParser:
         self.garbages = {}
         self.page_cum_height = [0]
         self.page_layout = []
+        self.layout_dets = None
         self.page_from = page_from
         st = timer()
         try:
             self.pdf = pdfplumber.open(fnm) if isinstance(
                 fnm, str) else pdfplumber.open(BytesIO(fnm))
-            self.page_images = [p.to_image(resolution=72 * zoomin).annotated for i, p in
-                                enumerate(self.pdf.pages[page_from:page_to])]
-            self.page_chars = [[{**c, 'top': c['top'], 'bottom': c['bottom']} for c in page.dedupe_chars().chars if self._has_color(c)] for page in
-                               self.pdf.pages[page_from:page_to]]
+            self.page_images = PageImages(self.pdf, page_from, page_to, 72 * zoomin)
+            self.page_chars = [self._page_chars(page) for page in self.pdf.pages[page_from:page_to]]
             self.total_page = len(self.pdf.pages)
         except Exception as e:
             logging.error(str(e))
@@ -987,27 +1070,17 @@ class RAGFlowPdfParser:
             self.is_english = False
 
         st = timer()
-        for i, img in enumerate(self.page_images):
-            chars = self.page_chars[i] if not self.is_english else []
-            self.mean_height.append(
-                np.median(sorted([c["height"] for c in chars])) if chars else 0
-            )
-            self.mean_width.append(
-                np.median(sorted([c["width"] for c in chars])) if chars else 8
-            )
-            self.page_cum_height.append(img.size[1] / zoomin)
-            j = 0
-            while j + 1 < len(chars):
-                if chars[j]["text"] and chars[j + 1]["text"] \
-                        and re.match(r"[0-9a-zA-Z,.:;!%]+", chars[j]["text"] + chars[j + 1]["text"]) \
-                        and chars[j + 1]["x0"] - chars[j]["x1"] >= min(chars[j + 1]["width"],
-                                                                       chars[j]["width"]) / 2:
-                    chars[j]["text"] += " "
-                j += 1
-
-            self.__ocr(i + 1, img, chars, zoomin)
-            if callback and i % 6 == 5:
-                callback(prog=(i + 1) * 0.6 / len(self.page_images), msg="")
+        # workers are only used if init_pool() started them before any thread
+        pool = _pool if len(self.page_images) >= PDF_PARSER_PARALLEL_PAGES else None
+        if pool and not self._ocr_pages_parallel(pool, fnm, zoomin, page_from, callback):
+            self.lefted_chars, self.mean_height, self.mean_width = [], [], []
+            self.boxes, self.page_cum_height, self.layout_dets = [], [0], None
+            pool = None
+        if not pool:
+            for i, img in enumerate(self.page_images):
+                self._ocr_page(i, img, zoomin)
+                if callback and i % 6 == 5:
+                    callback(prog=(i + 1) * 0.6 / len(self.page_images), msg="")
         # print("OCR:", timer()-st)
 
         if not self.is_english and not any(
@@ -1134,6 +1207,160 @@ class RAGFlowPdfParser:
         return poss
 
 
+_pool = None
+_pool_lock = threading.Lock()
+# models of a page worker process, loaded by its first job
+_page_models = {}
+
+
+def init_pool():
+    """
+    The PDF_PARSER_WORKERS page workers, or None if pages are parsed in turn.
+    They fork from this process like the tokenizer's, so this must be called
+    before any thread is started; without it pages are parsed in turn.
+    """
+    global _pool
+    if PDF_PARSER_WORKERS < 2 or multiprocessing.current_process().daemon:
+        return
+    with _pool_lock:
+        if _pool is None:
+            if "fork" in multiprocessing.get_all_start_methods():
+                ctx = multiprocessing.get_context("fork")
+            else:
+                ctx = multiprocessing.get_context()
+            _pool = ProcessPoolExecutor(max_workers=PDF_PARSER_WORKERS, mp_context=ctx)
+            # with fork all workers are started by the first submit
+            _pool.submit(int).result()
+        return _pool
+
+
+def reset_pool():
+    global _pool
+    with _pool_lock:
+        _pool = None
+
+
+def _parse_pages(fnm, zoomin, page_from, start, end, is_english, layout_domain):
+    """
+    Render, OCR and detect the layout of pages [start, end) of the range
+    that starts at `page_from`, in a page worker with its own ONNX sessions.
+    """
+    if "ocr" not in _page_models:
+        _page_models["ocr"] = OCR()
+    if layout_domain not in _page_models:
+        _page_models[layout_domain] = LayoutRecognizer(layout_domain)
+
+    psr = RAGFlowPdfParser.__new__(RAGFlowPdfParser)
+    psr.ocr = _page_models["ocr"]
+    psr.is_english = is_english
+    psr.lefted_chars, psr.boxes, psr.page_cum_height = [], [], [0]
+    # indexed by page number like in the parent process
+    psr.mean_height, psr.mean_width = [0] * start, [8] * start
+    with pdfplumber.open(fnm) if isinstance(fnm, str) else pdfplumber.open(BytesIO(fnm)) as pdf:
+        images = PageImages(pdf, page_from + start, page_from + end, 72 * zoomin)
+        psr.page_chars = [[]] * start + [psr._page_chars(p) for p in pdf.pages[page_from + start:page_from + end]]
+        for i, img in enumerate(images):
+            psr._ocr_page(start + i, img, zoomin)
+        layout_dets = Recognizer.__call__(_page_models[layout_domain], images, 0.2, 16)
+        sizes = [images.size(i) for i in range(len(images))]
+
+    return {"boxes": psr.boxes, "mean_height": psr.mean_height[start:], "mean_width": psr.mean_width[start:],
+            "page_cum_height": psr.page_cum_height[1:], "lefted_chars": psr.lefted_chars,
+            "layout_dets": layout_dets, "sizes": sizes}
+
+
+class PageImage:
+    """
+    A page of PageImages. Its size is known without rendering it; anything
+    else is done on the page image, decoded or rendered when needed.
+    """
+
+    def __init__(self, pages, i):
+        self._pages = pages
+        self._i = i
+
+    @property
+    def size(self):
+        return self._pages.size(self._i)
+
+    @property
+    def __array_interface__(self):
+        return self._pages.image(self._i).__array_interface__
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._pages.image(self._i), name)
+
+    def materialize(self):
+        """The page as a PIL image, independent of the parser."""
+        return self._pages.image(self._i)
+
+
+class PageImages:
+    """
+    The images of pages [page_from, page_to) of a pdfplumber PDF, rendered on
+    demand. The PDF_PAGE_CACHE_SIZE most recently used stay decoded, the
+    others are kept PNG-compressed in a temporary file.
+    """
+
+    def __init__(self, pdf, page_from, page_to, resolution):
+        self._pages = pdf.pages[page_from:page_to]
+        self._resolution = resolution
+        self._sizes = [None] * len(self._pages)
+        self._decoded = OrderedDict()
+        self._spilled = {}
+        self._spill = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pages)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [PageImage(self, j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("page index out of range")
+        return PageImage(self, i)
+
+    def size(self, i):
+        if self._sizes[i] is None:
+            self.image(i)
+        return self._sizes[i]
+
+    def set_size(self, i, size):
+        self._sizes[i] = tuple(size)
+
+    def image(self, i):
+        with self._lock:
+            if i in self._decoded:
+                self._decoded.move_to_end(i)
+                return self._decoded[i]
+            if i in self._spilled:
+                offset, length = self._spilled[i]
+                self._spill.seek(offset)
+                img = Image.open(BytesIO(self._spill.read(length)))
+                img.load()
+            else:
+                img = self._pages[i].to_image(resolution=self._resolution).annotated
+                self._sizes[i] = img.size
+            self._decoded[i] = img
+            while len(self._decoded) > max(1, PDF_PAGE_CACHE_SIZE):
+                j, old = self._decoded.popitem(last=False)
+                if j in self._spilled:
+                    continue
+                if self._spill is None:
+                    self._spill = tempfile.TemporaryFile()
+                buf = BytesIO()
+                old.save(buf, format="PNG", compress_level=1)
+                self._spill.seek(0, os.SEEK_END)
+                self._spilled[j] = (self._spill.tell(), buf.tell())
+                self._spill.write(buf.getvalue())
+            return img
+
+
 class PlainParser(object):
     def __call__(self, filename, from_page=0, to_page=100000, **kwargs):
         self.outlines = []
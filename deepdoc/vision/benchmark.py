@@ -0,0 +1,170 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Benchmarks of the deepdoc models on sample pages.
+
+    python -m deepdoc.vision.benchmark threads --inputs <PDF, image or directory> [--threads 1,2,4] [--pages 8]
+    python -m deepdoc.vision.benchmark int8 --inputs <PDF, image or directory> [--pages 8]
+"""
+import argparse
+import difflib
+import os
+import time
+
+import numpy as np
+import pdfplumber
+from PIL import Image
+
+from api.utils.file_utils import get_project_base_directory, traversal_files
+from deepdoc.vision import OCR, Recognizer, LayoutRecognizer, TableStructureRecognizer, session
+
+
+def load_pages(inputs, n, zoomin=3):
+    """Up to n page images of the PDFs and images under `inputs`."""
+    images = []
+    for fnm in sorted(traversal_files(inputs)) if os.path.isdir(inputs) else [inputs]:
+        if fnm.split(".")[-1].lower() == "pdf":
+            with pdfplumber.open(fnm) as pdf:
+                images.extend(p.to_image(resolution=72 * zoomin).annotated for p in pdf.pages[:n - len(images)])
+        else:
+            images.append(Image.open(fnm).convert("RGB"))
+        if len(images) >= n:
+            break
+    return images[:n]
+
+
+def run_models(images):
+    """
+    Seconds per page of each model, after a warm-up page, and what they
+    found: text boxes, text, layouts and table components of each page.
+    """
+    ocr = OCR()
+    layouter = LayoutRecognizer("layout")
+    tsr = TableStructureRecognizer()
+    imgs = [np.array(img) for img in images]
+    ocr(imgs[0])
+    Recognizer.__call__(layouter, imgs[:1], 0.2, 16)
+    Recognizer.__call__(tsr, imgs[:1], 0.2)
+
+    res = {"det": 0, "rec": 0}
+    found = {"det": [], "rec": []}
+    for img in imgs:
+        st = time.perf_counter()
+        dt_boxes, _ = ocr.text_detector(img)
+        res["det"] += time.perf_counter() - st
+        if dt_boxes is None:
+            found["det"].append([])
+            found["rec"].append("")
+            continue
+        dt_boxes = ocr.sorted_boxes(dt_boxes)
+        found["det"].append([("text", [b[:, 0].min(), b[:, 1].min(), b[:, 0].max(), b[:, 1].max()])
+                             for b in dt_boxes])
+        crops = [ocr.get_rotate_crop_image(img, b) for b in dt_boxes]
+        st = time.perf_counter()
+        rec_res, _ = ocr.text_recognizer(crops)
+        res["rec"] += time.perf_counter() - st
+        found["rec"].append(" ".join(t for t, _ in rec_res))
+    for name, mdl in [("layout", layouter), ("tsr", tsr)]:
+        st = time.perf_counter()
+        dets = Recognizer.__call__(mdl, imgs, 0.2, 16)
+        res[name] = time.perf_counter() - st
+        found[name] = [[(b["type"], b["bbox"]) for b in page] for page in dets]
+    return {k: v / len(imgs) for k, v in res.items()}, found
+
+
+def _iou(a, b):
+    w = min(a[2], b[2]) - max(a[0], b[0])
+    h = min(a[3], b[3]) - max(a[1], b[1])
+    if w <= 0 or h <= 0:
+        return 0
+    return w * h / ((a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - w * h)
+
+
+def box_f1(ref, got, thr=0.5):
+    """F1 of the (type, bbox) pairs of `got` against those of `ref`, page by page, at IoU >= thr."""
+    tp = n_ref = n_got = 0
+    for r, g in zip(ref, got):
+        n_ref += len(r)
+        n_got += len(g)
+        g = list(g)
+        for tp_r, box_r in r:
+            cands = [(_iou(box_r, box_g), i) for i, (tp_g, box_g) in enumerate(g) if tp_g == tp_r]
+            if cands and max(cands)[0] >= thr:
+                g.pop(max(cands)[1])
+                tp += 1
+    return 2. * tp / (n_ref + n_got) if n_ref + n_got else 1.
+
+
+def text_similarity(ref, got):
+    return float(np.mean([difflib.SequenceMatcher(None, r, g).ratio() for r, g in zip(ref, got)]))
+
+
+def bench_threads(inputs, threads, pages):
+    images = load_pages(inputs, pages)
+    print("%d pages, %d cores" % (len(images), os.cpu_count()))
+    runs = {}
+    for n in threads:
+        session.set_intra_op_num_threads(n)
+        runs[n], _ = run_models(images)
+        print("threads %-3d " % n + "  ".join("%s %.3fs" % (k, v) for k, v in runs[n].items()) +
+              "  total %.3fs/page" % sum(runs[n].values()))
+    for k in runs[threads[0]].keys():
+        best = min(threads, key=lambda n: runs[n][k])
+        print("%-7s fastest with %d threads" % (k, best))
+    best = min(threads, key=lambda n: sum(runs[n].values()))
+    print("ONNX_INTRA_OP_THREADS=%d" % best)
+
+
+def bench_int8(inputs, pages):
+    images = load_pages(inputs, pages)
+    print("%d pages, %d cores" % (len(images), os.cpu_count()))
+    model_dir = os.path.join(get_project_base_directory(), "rag/res/deepdoc")
+    missing = [nm for nm in ["det", "rec", "layout", "tsr"]
+               if not os.path.exists(os.path.join(model_dir, nm + ".int8.onnx"))]
+    if missing:
+        print("No INT8 version of %s, see python -m deepdoc.vision.quantize" % ", ".join(missing))
+    session.set_int8_models(False)
+    fp32, ref = run_models(images)
+    session.set_int8_models(True)
+    int8, got = run_models(images)
+    agreement = {"det": box_f1(ref["det"], got["det"]),
+                 "rec": text_similarity(ref["rec"], got["rec"]),
+                 "layout": box_f1(ref["layout"], got["layout"]),
+                 "tsr": box_f1(ref["tsr"], got["tsr"])}
+    # boxes are matched by F1 at IoU 0.5, the text of the pages by edit similarity
+    print("%-7s %12s %12s %8s %10s" % ("model", "fp32 s/page", "int8 s/page", "speedup", "agreement"))
+    for k in fp32.keys():
+        print("%-7s %12.3f %12.3f %7.2fx %10.3f" % (k, fp32[k], int8[k], fp32[k] / max(int8[k], 1e-9), agreement[k]))
+    print("%-7s %12.3f %12.3f %7.2fx" % ("total", sum(fp32.values()), sum(int8.values()),
+                                          sum(fp32.values()) / max(sum(int8.values()), 1e-9)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="bench", required=True)
+    p = sub.add_parser("threads", help="seconds per page of each model by intra-op thread count; "
+                                       "run as many in parallel as there are PDF page workers")
+    p.add_argument("--inputs", required=True, help="a PDF, an image or a directory of them")
+    p.add_argument("--threads", default="1,2,4,8", help="comma separated thread counts")
+    p.add_argument("--pages", type=int, default=8, help="number of pages")
+    p = sub.add_parser("int8", help="speed and agreement with the fp32 models of the INT8 ones")
+    p.add_argument("--inputs", required=True, help="a PDF, an image or a directory of them")
+    p.add_argument("--pages", type=int, default=8, help="number of pages")
+    args = parser.parse_args()
+    if args.bench == "threads":
+        bench_threads(args.inputs, [int(n) for n in args.threads.split(",")], args.pages)
+    elif args.bench == "int8":
+        bench_int8(args.inputs, args.pages)
@@ -0,0 +1,146 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+INT8 versions of the deepdoc models for CPU-only hosts. Each one is saved
+next to its model as <model>.int8.onnx, which is then loaded instead of the
+model unless ONNX_INT8_MODELS is off.
+
+    python -m deepdoc.vision.quantize --calibration <PDF, image or directory> [--pages 16] [--models det,rec,layout,tsr] [--dynamic]
+
+The convolutional models (det, layout*, tsr) are quantized statically, with
+activation ranges calibrated on the inputs they get while parsing the
+calibration pages; rec, and every model with --dynamic, dynamically.
+`python -m deepdoc.vision.benchmark int8` reports the speed and agreement.
+"""
+import argparse
+import glob
+import logging
+import os
+import tempfile
+
+import numpy as np
+from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic, quantize_static
+from onnxruntime.quantization.shape_inference import quant_pre_process
+
+from api.utils.file_utils import get_project_base_directory
+from deepdoc.vision import OCR, Recognizer, LayoutRecognizer, TableStructureRecognizer, session
+from deepdoc.vision.benchmark import load_pages
+
+STATIC = ["det", "layout", "tsr"]
+
+
+class _Recorder:
+    """A session keeping the first `limit` inputs it runs on."""
+
+    def __init__(self, sess, limit):
+        self.sess = sess
+        self.limit = limit
+        self.feeds = []
+
+    def run(self, output_names, input_feed, *args, **kwargs):
+        if len(self.feeds) < self.limit:
+            self.feeds.append(dict(input_feed))
+        return self.sess.run(output_names, input_feed, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.sess, name)
+
+
+class _Feeds(CalibrationDataReader):
+    def __init__(self, feeds):
+        self.feeds = iter(feeds)
+
+    def get_next(self):
+        return next(self.feeds, None)
+
+
+def calibration_feeds(images, names, limit):
+    """Up to `limit` inputs of each of the models `names` on the calibration pages."""
+    session.set_int8_models(False)
+    imgs = [np.array(img) for img in images]
+    feeds = {}
+    if "det" in names or "rec" in names:
+        ocr = OCR()
+        ocr.text_detector.predictor = _Recorder(ocr.text_detector.predictor, limit)
+        ocr.text_recognizer.predictor = _Recorder(ocr.text_recognizer.predictor, limit)
+        for img in imgs:
+            ocr(img)
+        feeds["det"] = ocr.text_detector.predictor.feeds
+        feeds["rec"] = ocr.text_recognizer.predictor.feeds
+
+    tables = []
+    layouts = [nm for nm in names if nm.startswith("layout")]
+    for domain in layouts or (["layout"] if "tsr" in names else []):
+        layouter = LayoutRecognizer(domain)
+        layouter.ort_sess = _Recorder(layouter.ort_sess, limit)
+        for img, page in zip(images, Recognizer.__call__(layouter, imgs, 0.2, 16)):
+            tables.extend(img.crop(b["bbox"]) for b in page if b["type"].lower() == "table")
+        feeds[domain] = layouter.ort_sess.feeds
+
+    if "tsr" in names:
+        tsr = TableStructureRecognizer()
+        tsr.ort_sess = _Recorder(tsr.ort_sess, limit)
+        # the structure recognizer sees table crops; whole pages if there are none
+        Recognizer.__call__(tsr, [np.array(t) for t in tables] or imgs, 0.2)
+        feeds["tsr"] = tsr.ort_sess.feeds
+    return feeds
+
+
+def quantize(model_dir, name, feeds=None):
+    """Saves the INT8 version of model `name`: static if calibration inputs are given, else dynamic."""
+    src = os.path.join(model_dir, name + ".onnx")
+    dst = os.path.join(model_dir, name + ".int8.onnx")
+    with tempfile.TemporaryDirectory() as tmp:
+        pre = os.path.join(tmp, name + ".onnx")
+        try:
+            quant_pre_process(src, pre)
+        except Exception as e:
+            logging.warning("Pre-processing of {} failed: {}".format(src, e))
+            pre = src
+        if feeds:
+            quantize_static(pre, dst, _Feeds(feeds), quant_format=QuantFormat.QDQ, per_channel=True,
+                            activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+        else:
+            quantize_dynamic(pre, dst, weight_type=QuantType.QInt8)
+    print("{}: {:.1f}MB -> {:.1f}MB".format(dst, os.path.getsize(src) / 1024. / 1024.,
+                                           os.path.getsize(dst) / 1024. / 1024.))
+
+
+def main(args):
+    model_dir = os.path.join(get_project_base_directory(), "rag/res/deepdoc")
+    names = ["det", "rec", "tsr"] + sorted(os.path.basename(f)[:-len(".onnx")]
+                                          for f in glob.glob(os.path.join(model_dir, "layout*.onnx"))
+                                          if not f.endswith(".int8.onnx"))
+    names = [nm for nm in names if nm.split(".")[0] in args.models.split(",")]
+    static = [nm for nm in names if nm.split(".")[0] in STATIC and not args.dynamic]
+    feeds = {}
+    if static:
+        feeds = calibration_feeds(load_pages(args.calibration, args.pages), static, args.limit)
+    for nm in names:
+        quantize(model_dir, nm, feeds.get(nm))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calibration", help="a PDF, an image or a directory of them, like the documents to parse")
+    parser.add_argument("--pages", type=int, default=16, help="number of calibration pages")
+    parser.add_argument("--limit", type=int, default=64, help="calibration inputs per model")
+    parser.add_argument("--models", default="det,rec,layout,tsr", help="comma separated models")
+    parser.add_argument("--dynamic", action="store_true", help="quantize every model dynamically")
+    args = parser.parse_args()
+    if not args.dynamic and not args.calibration:
+        parser.error("--calibration is required unless --dynamic")
+    main(args)
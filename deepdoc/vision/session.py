@@ -0,0 +1,86 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+
+import logging
+import os
+import re
+import threading
+
+import onnxruntime as ort
+
+from rag.settings import ONNX_INTRA_OP_THREADS, ONNX_CPU_MEM_ARENA, ONNX_INT8_MODELS
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_sessions_pid = None
+_intra_op_num_threads = ONNX_INTRA_OP_THREADS
+_int8_models = ONNX_INT8_MODELS
+
+
+def session_options(intra_op_num_threads=None):
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    options.intra_op_num_threads = _intra_op_num_threads if intra_op_num_threads is None else intra_op_num_threads
+    options.inter_op_num_threads = 1
+    options.enable_cpu_mem_arena = ONNX_CPU_MEM_ARENA
+    options.enable_mem_pattern = True
+    return options
+
+
+def model_variant(model_file_path):
+    """The INT8 version of a model if there is one and they are enabled, else the model."""
+    if _int8_models:
+        int8_file_path = re.sub(r"\.onnx$", ".int8.onnx", model_file_path)
+        if os.path.exists(int8_file_path):
+            return int8_file_path
+    return model_file_path
+
+
+def get_session(model_file_path):
+    """
+    The session of an ONNX model shared by the whole process, created by
+    its first user. Sessions are not inherited across fork: the thread
+    pools of ONNX Runtime do not survive it.
+    """
+    global _sessions_pid
+    model_file_path = os.path.abspath(model_variant(model_file_path))
+    with _sessions_lock:
+        if _sessions_pid != os.getpid():
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+        if model_file_path not in _sessions:
+            logging.info("Loading ONNX model " + model_file_path)
+            _sessions[model_file_path] = ort.InferenceSession(
+                model_file_path, sess_options=session_options(), providers=['CPUExecutionProvider'])
+        return _sessions[model_file_path]
+
+
+def set_intra_op_num_threads(n):
+    """Threads of the sessions created from now on; drops the existing ones."""
+    global _intra_op_num_threads
+    with _sessions_lock:
+        _intra_op_num_threads = n
+        _sessions.clear()
+
+
+def set_int8_models(enabled):
+    """Whether the sessions created from now on use INT8 models; drops the existing ones."""
+    global _int8_models
+    with _sessions_lock:
+        _int8_models = enabled
+        _sessions.clear()
@@ -19,7 +19,7 @@ import re
 
 from api.db import ParserType
 from io import BytesIO
-from rag.nlp import rag_tokenizer, tokenize, tokenize_table, add_positions, bullets_category, title_frequency, tokenize_chunks, docx_question_level
+from rag.nlp import rag_tokenizer, tokenize, tokenize_docs, tokenize_table, add_positions, bullets_category, title_frequency, tokenize_chunks, docx_question_level
 from deepdoc.parser import PdfParser, PlainParser
 from rag.utils import num_tokens_from_string
 from deepdoc.parser import PdfParser, ExcelParser, DocxParser
@@ -249,11 +249,13 @@ def chunk(filename, binary=None, from_page=0, to_page=100000,
         ti_list, tbls = docx_parser(filename, binary,
                                     from_page=0, to_page=10000, callback=callback)
         res = tokenize_table(tbls, doc, eng)
+        docs = []
         for text, image in ti_list:
             d = copy.deepcopy(doc)
             d['image'] = image
-            tokenize(d, text, eng)
-            res.append(d)
+            docs.append(d)
+        tokenize_docs(docs, [text for text, _ in ti_list], eng)
+        res.extend(docs)
         return res
     else:
         raise NotImplementedError("file type not supported yet(pdf and docx supported)")
@@ -15,7 +15,6 @@ from copy import deepcopy
 from io import BytesIO
 from timeit import default_timer as timer
 from nltk import word_tokenize
-from openpyxl import load_workbook
 from rag.nlp import is_english, random_choices, find_codec, qbullets_category, add_positions, has_qbullet, docx_question_level
 from rag.nlp import rag_tokenizer, tokenize_table, concat_img
 from rag.settings import cron_logger
@@ -25,19 +24,14 @@ from PIL import Image
 from markdown import markdown
 class Excel(ExcelParser):
     def __call__(self, fnm, binary=None, callback=None):
-        if not binary:
-            wb = load_workbook(fnm)
-        else:
-            wb = load_workbook(BytesIO(binary))
-        total = 0
-        for sheetname in wb.sheetnames:
-            total += len(list(wb[sheetname].rows))
+        wb = self.open_workbook(binary if binary else fnm)
+        # only for the progress; rows are read up to where the sheets actually end
+        total = max(1, sum(wb[sheetname].max_row or 0 for sheetname in wb.sheetnames))
 
         res, fails = [], []
         for sheetname in wb.sheetnames:
             ws = wb[sheetname]
-            rows = list(ws.rows)
-            for i, r in enumerate(rows):
+            for i, r in enumerate(self.sheet_rows(ws)):
                 q, a = "", ""
                 for cell in r:
                     if not cell.value:
@@ -59,6 +53,7 @@ class Excel(ExcelParser):
                                      (f"{len(fails)} failure, line: %s..." %
                                       (",".join(fails[:3])) if fails else "")))
 
+        wb.close()
         callback(0.6, ("Extract Q&A: {}. ".format(len(res)) + (
             f"{len(fails)} failure, line: %s..." % (",".join(fails[:3])) if fails else "")))
         self.is_english = is_english(
@@ -244,34 +239,45 @@ def rmPrefix(txt):
         r"^(问题|答案|回答|user|assistant|Q|A|Question|Answer|问|答)[\t:： ]+", "", txt.strip(), flags=re.IGNORECASE)
 
 
-def beAdocPdf(d, q, a, eng, image, poss):
+def tokenizeQuestion(d, q, pending=None):
+    if pending is not None:
+        pending.append((d, q))
+        return
+    d["content_ltks"] = rag_tokenizer.tokenize(q)
+    d["content_sm_ltks"] = rag_tokenizer.fine_grained_tokenize(d["content_ltks"])
+
+
+def tokenizePending(pending):
+    for (d, _), (ltks, sm_ltks) in zip(pending, rag_tokenizer.tokenize_batch([q for _, q in pending])):
+        d["content_ltks"] = ltks
+        d["content_sm_ltks"] = sm_ltks
+
+
+def beAdocPdf(d, q, a, eng, image, poss, pending=None):
     qprefix = "Question: " if eng else "问题："
     aprefix = "Answer: " if eng else "回答："
     d["content_with_weight"] = "\t".join(
         [qprefix + rmPrefix(q), aprefix + rmPrefix(a)])
-    d["content_ltks"] = rag_tokenizer.tokenize(q)
-    d["content_sm_ltks"] = rag_tokenizer.fine_grained_tokenize(d["content_ltks"])
+    tokenizeQuestion(d, q, pending)
     d["image"] = image
     add_positions(d, poss)
     return d
 
-def beAdocDocx(d, q, a, eng, image):
+def beAdocDocx(d, q, a, eng, image, pending=None):
     qprefix = "Question: " if eng else "问题："
     aprefix = "Answer: " if eng else "回答："
     d["content_with_weight"] = "\t".join(
         [qprefix + rmPrefix(q), aprefix + rmPrefix(a)])
-    d["content_ltks"] = rag_tokenizer.tokenize(q)
-    d["content_sm_ltks"] = rag_tokenizer.fine_grained_tokenize(d["content_ltks"])
+    tokenizeQuestion(d, q, pending)
     d["image"] = image
     return d
 
-def beAdoc(d, q, a, eng):
+def beAdoc(d, q, a, eng, pending=None):
     qprefix = "Question: " if eng else "问题："
     aprefix = "Answer: " if eng else "回答："
     d["content_with_weight"] = "\t".join(
         [qprefix + rmPrefix(q), aprefix + rmPrefix(a)])
-    d["content_ltks"] = rag_tokenizer.tokenize(q)
-    d["content_sm_ltks"] = rag_tokenizer.fine_grained_tokenize(d["content_ltks"])
+    tokenizeQuestion(d, q, pending)
     return d
 
 
@@ -293,6 +299,8 @@ def chunk(filename, binary=None, lang="Chinese", callback=None, **kwargs):
     """
     eng = lang.lower() == "english"
     res = []
+    # questions are tokenized together at the end, see tokenizePending
+    pending = []
     doc = {
         "docnm_kwd": filename,
         "title_tks": rag_tokenizer.tokenize(re.sub(r"\.[a-zA-Z]+$", "", filename))
@@ -301,7 +309,8 @@ def chunk(filename, binary=None, lang="Chinese", callback=None, **kwargs):
         callback(0.1, "Start to parse.")
         excel_parser = Excel()
         for q, a in excel_parser(filename, binary, callback):
-            res.append(beAdoc(deepcopy(doc), q, a, eng))
+            res.append(beAdoc(deepcopy(doc), q, a, eng, pending))
+        tokenizePending(pending)
         return res
     elif re.search(r"\.(txt|csv)$", filename, re.IGNORECASE):
         callback(0.1, "Start to parse.")
@@ -333,18 +342,19 @@ def chunk(filename, binary=None, lang="Chinese", callback=None, **kwargs):
                 else:
                     fails.append(str(i+1))
             elif len(arr) == 2:
-                if question and answer: res.append(beAdoc(deepcopy(doc), question, answer, eng))
+                if question and answer: res.append(beAdoc(deepcopy(doc), question, answer, eng, pending))
                 question, answer = arr
             i += 1
             if len(res) % 999 == 0:
                 callback(len(res) * 0.6 / len(lines), ("Extract Q&A: {}".format(len(res)) + (
                     f"{len(fails)} failure, line: %s..." % (",".join(fails[:3])) if fails else "")))
 
-        if question: res.append(beAdoc(deepcopy(doc), question, answer, eng))
+        if question: res.append(beAdoc(deepcopy(doc), question, answer, eng, pending))
 
         callback(0.6, ("Extract Q&A: {}".format(len(res)) + (
             f"{len(fails)} failure, line: %s..." % (",".join(fails[:3])) if fails else "")))
 
+        tokenizePending(pending)
         return res
     elif re.search(r"\.pdf$", filename, re.IGNORECASE):
         callback(0.1, "Start to parse.")
@@ -354,7 +364,8 @@ def chunk(filename, binary=None, lang="Chinese", callback=None, **kwargs):
         
 
         for q, a, image, poss in qai_list:
-            res.append(beAdocPdf(deepcopy(doc), q, a, eng, image, poss))
+            res.append(beAdocPdf(deepcopy(doc), q, a, eng, image, poss, pending))
+        tokenizePending(pending)
         return res
     elif re.search(r"\.(md|markdown)$", filename, re.IGNORECASE):
         callback(0.1, "Start to parse.")
@@ -387,7 +398,7 @@ def chunk(filename, binary=None, lang="Chinese", callback=None, **kwargs):
                 if last_answer.strip():
                     sum_question = '\n'.join(question_stack)
                     if sum_question:
-                        res.append(beAdoc(deepcopy(doc), sum_question, markdown(last_answer, extensions=['markdown.extensions.tables']), eng))
+                        res.append(beAdoc(deepcopy(doc), sum_question, markdown(last_answer, extensions=['markdown.extensions.tables']), eng, pending))
                     last_answer = ''
 
                 i = question_level
@@ -399,7 +410,8 @@ def chunk(filename, binary=None, lang="Chinese", callback=None, **kwargs):
         if last_answer.strip():
             sum_question = '\n'.join(question_stack)
             if sum_question:
-                res.append(beAdoc(deepcopy(doc), sum_question, markdown(last_answer, extensions=['markdown.extensions.tables']), eng))
+                res.append(beAdoc(deepcopy(doc), sum_question, markdown(last_answer, extensions=['markdown.extensions.tables']), eng, pending))
+        tokenizePending(pending)
         return res
     elif re.search(r"\.docx$", filename, re.IGNORECASE):
         docx_parser = Docx()
@@ -407,7 +419,8 @@ def chunk(filename, binary=None, lang="Chinese", callback=None, **kwargs):
                                     from_page=0, to_page=10000, callback=callback)
         res = tokenize_table(tbls, doc, eng)
         for q, a, image in qai_list:
-            res.append(beAdocDocx(deepcopy(doc), q, a, eng, image))
+            res.append(beAdocDocx(deepcopy(doc), q, a, eng, image, pending))
+        tokenizePending(pending)
         return res
 
     raise NotImplementedError(
@@ -12,64 +12,101 @@
 #
 import copy
 import re
-from io import BytesIO
+from io import BytesIO, TextIOWrapper
 from xpinyin import Pinyin
 import numpy as np
 import pandas as pd
-from openpyxl import load_workbook
 from dateutil.parser import parse as datetime_parse
 
 from api.db.services.knowledgebase_service import KnowledgebaseService
-from rag.nlp import rag_tokenizer, is_english, tokenize, find_codec
+from rag.nlp import rag_tokenizer, is_english, tokenize_docs, find_codec
 from deepdoc.parser import ExcelParser
 
 
 class Excel(ExcelParser):
     def __call__(self, fnm, binary=None, from_page=0,
                  to_page=10000000000, callback=None):
-        if not binary:
-            wb = load_workbook(fnm)
-        else:
-            wb = load_workbook(BytesIO(binary))
-        total = 0
-        for sheetname in wb.sheetnames:
-            total += len(list(wb[sheetname].rows))
+        wb = self.open_workbook(binary if binary else fnm)
 
         res, fails, done = [], [], 0
         rn = 0
         for sheetname in wb.sheetnames:
+            if rn >= to_page:
+                break
             ws = wb[sheetname]
-            rows = list(ws.rows)
-            if not rows:continue
-            headers = [cell.value for cell in rows[0]]
+            rows = self.sheet_rows(ws)
+            header = next(rows, None)
+            if not header:continue
+            m = len(header)
+            headers = [cell.value for cell in header]
             missed = set([i for i, h in enumerate(headers) if h is None])
             headers = [
                 cell.value for i,
                 cell in enumerate(
-                    rows[0]) if i not in missed]
+                    header) if i not in missed]
             if not headers:continue
+            # rows are parsed in one pass, up to the end of this task's window
             data = []
-            for i, r in enumerate(rows[1:]):
+            for i, r in enumerate(rows):
                 rn += 1
                 if rn - 1 < from_page:
                     continue
                 if rn - 1 >= to_page:
                     break
+                vals = [cell.value for cell in r[:m]]
+                vals += [None] * (m - len(vals))
                 row = [
-                    cell.value for ii,
-                    cell in enumerate(r) if ii not in missed]
+                    v for ii,
+                    v in enumerate(vals) if ii not in missed]
                 if len(row) != len(headers):
                     fails.append(str(i))
                     continue
                 data.append(row)
                 done += 1
-            res.append(pd.DataFrame(np.array(data), columns=headers))
+            if data:
+                res.append(pd.DataFrame(np.array(data), columns=headers))
+        wb.close()
 
         callback(0.3, ("Extract records: {}~{}".format(from_page + 1, min(to_page, from_page + rn)) + (
             f"{len(fails)} failure, line: %s..." % (",".join(fails[:3])) if fails else "")))
         return res
 
 
+def text_lines(filename, binary=None, from_page=0, to_page=10000000000, byte_range=None):
+    """
+    Yield the header line of a csv/txt file, then (i, line) for its data lines
+    from_page..to_page, reading one line at a time. `byte_range` is where those
+    lines are in `binary` (indexed by queue_tasks); only that slice is decoded.
+    """
+    if binary:
+        encoding = find_codec(binary)
+        if byte_range and "\n".encode(encoding) == b"\n":
+            s, e = byte_range
+            if 0 < s <= e <= len(binary) and binary[s - 1:s] == b"\n":
+                yield binary[:binary.find(b"\n")].decode(encoding, errors="ignore")
+                lines = binary[s:e].decode(encoding, errors="ignore").split("\n")
+                if e < len(binary):
+                    lines.pop()  # the empty string after the slice's last newline
+                for i, l in enumerate(lines[:to_page - from_page]):
+                    yield from_page + i, l
+                return
+        f = TextIOWrapper(BytesIO(binary), encoding=encoding, errors="ignore", newline="\n")
+    else:
+        f = open(filename, "r")
+
+    with f:
+        for i, l in enumerate(f):
+            l = l[:-1] if l.endswith("\n") else l
+            if i == 0:
+                yield l
+                continue
+            if i - 1 < from_page:
+                continue
+            if i - 1 >= to_page:
+                break
+            yield i - 1, l
+
+
 def trans_datatime(s):
     try:
         return datetime_parse(s.strip()).strftime("%Y-%m-%d %H:%M:%S")
@@ -146,36 +183,23 @@ def chunk(filename, binary=None, from_page=0, to_page=10000000000,
             callback=callback)
     elif re.search(r"\.(txt|csv)$", filename, re.IGNORECASE):
         callback(0.1, "Start to parse.")
-        txt = ""
-        if binary:
-            encoding = find_codec(binary)
-            txt = binary.decode(encoding, errors="ignore")
-        else:
-            with open(filename, "r") as f:
-                while True:
-                    l = f.readline()
-                    if not l:
-                        break
-                    txt += l
-        lines = txt.split("\n")
+        lines = text_lines(filename, binary, from_page, to_page, kwargs.get("byte_range"))
         fails = []
-        headers = lines[0].split(kwargs.get("delimiter", "\t"))
+        headers = next(lines, "").split(kwargs.get("delimiter", "\t"))
         rows = []
-        for i, line in enumerate(lines[1:]):
-            if i < from_page:
-                continue
-            if i >= to_page:
-                break
+        end = from_page
+        for i, line in lines:
+            end = i + 1
             row = [l for l in line.split(kwargs.get("delimiter", "\t"))]
             if len(row) != len(headers):
                 fails.append(str(i))
                 continue
             rows.append(row)
 
-        callback(0.3, ("Extract records: {}~{}".format(from_page, min(len(lines), to_page)) + (
+        callback(0.3, ("Extract records: {}~{}".format(from_page, end) + (
             f"{len(fails)} failure, line: %s..." % (",".join(fails[:3])) if fails else "")))
 
-        dfs = [pd.DataFrame(np.array(rows), columns=headers)]
+        dfs = [pd.DataFrame(rows, columns=headers)]
 
     else:
         raise NotImplementedError(
@@ -214,10 +238,12 @@ def chunk(filename, binary=None, from_page=0, to_page=10000000000,
                      for i in range(len(clmns))]
 
         eng = lang.lower() == "english"  # is_english(txts)
+        title_tks = rag_tokenizer.tokenize(re.sub(r"\.[a-zA-Z]+$", "", filename))
+        row_txts, cells = [], []
         for ii, row in df.iterrows():
             d = {
                 "docnm_kwd": filename,
-                "title_tks": rag_tokenizer.tokenize(re.sub(r"\.[a-zA-Z]+$", "", filename))
+                "title_tks": title_tks
             }
             row_txt = []
             for j in range(len(clmns)):
@@ -228,13 +254,18 @@ def chunk(filename, binary=None, from_page=0, to_page=10000000000,
                 if pd.isna(row[clmns[j]]):
                     continue
                 fld = clmns_map[j][0]
-                d[fld] = row[clmns[j]] if clmn_tys[j] != "text" else rag_tokenizer.tokenize(
-                    row[clmns[j]])
+                if clmn_tys[j] != "text":
+                    d[fld] = row[clmns[j]]
+                else:
+                    cells.append((d, fld, row[clmns[j]]))
                 row_txt.append("{}:{}".format(clmns[j], row[clmns[j]]))
             if not row_txt:
                 continue
-            tokenize(d, "; ".join(row_txt), eng)
+            row_txts.append("; ".join(row_txt))
             res.append(d)
+        for (d, fld, _), tks in zip(cells, rag_tokenizer.tokenize_batch([c for _, _, c in cells], fine_grained=False)):
+            d[fld] = tks
+        tokenize_docs(res, row_txts, eng)
 
         KnowledgebaseService.update_parser_config(
             kwargs["kb_id"], {"field_map": {k: v for k, v in clmns_map}})
@@ -13,7 +13,11 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import random
 import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 import threading
 import requests
@@ -34,13 +38,96 @@ from rag.utils import num_tokens_from_string, truncate
 import google.generativeai as genai 
 import json
 
+class RateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute budget over a sliding one-minute
+    window, shared by every instance of a provider/model in the process.
+    A budget of 0 means unlimited.
+    """
+    _limiters = {}
+    _limiters_lock = threading.Lock()
+
+    def __init__(self, rpm=0, tpm=0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.lock = threading.Lock()
+        self.events = deque()
+        self.tokens = 0
+
+    @classmethod
+    def get(cls, name, rpm=0, tpm=0):
+        with cls._limiters_lock:
+            if name not in cls._limiters:
+                cls._limiters[name] = RateLimiter(rpm, tpm)
+            return cls._limiters[name]
+
+    def acquire(self, tokens=0):
+        if not self.rpm and not self.tpm:
+            return
+        while True:
+            with self.lock:
+                now = time.time()
+                while self.events and now - self.events[0][0] >= 60:
+                    self.tokens -= self.events.popleft()[1]
+                if (not self.rpm or len(self.events) < self.rpm) and \
+                        (not self.tpm or not self.events or self.tokens + tokens <= self.tpm):
+                    self.events.append((now, tokens))
+                    self.tokens += tokens
+                    return
+                wait = 60 - (now - self.events[0][0])
+            time.sleep(max(0.05, wait))
+
+
+def is_rate_limited(e):
+    if getattr(e, "status_code", None) == 429 or getattr(e, "status", None) == 429:
+        return True
+    return re.search(r"(429|rate.?limit|too many requests|throttl)", str(e), re.IGNORECASE) is not None
+
+
 class Base(ABC):
+    # Dispatch settings for remote providers, see `_dispatch`.
+    max_concurrency = int(os.environ.get("EMBEDDING_MAX_CONCURRENCY", 4))
+    rpm = int(os.environ.get("EMBEDDING_RPM", 0))
+    tpm = int(os.environ.get("EMBEDDING_TPM", 0))
+    max_retries = 5
+
     def __init__(self, key, model_name):
         pass
 
     def encode(self, texts: list, batch_size=32):
         raise NotImplementedError("Please implement encode method!")
 
+    def _dispatch(self, texts: list, batch_size, encode_batch):
+        """
+        Split `texts` into requests of `batch_size` and run `encode_batch` on them
+        with up to `max_concurrency` requests in flight, within the provider's
+        rpm/tpm budget. Rate-limited requests are retried with jittered backoff.
+        Returns the embeddings in input order and the total token count.
+        """
+        batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+        if not batches:
+            return np.array([]), 0
+        limiter = RateLimiter.get(self.__class__.__name__ + "/" + str(getattr(self, "model_name", "")),
+                                  self.rpm, self.tpm)
+
+        def run(batch):
+            tokens = sum([num_tokens_from_string(t) for t in batch]) if limiter.tpm else 0
+            for i in range(self.max_retries):
+                limiter.acquire(tokens)
+                try:
+                    return encode_batch(batch)
+                except Exception as e:
+                    if i + 1 == self.max_retries or not is_rate_limited(e):
+                        raise e
+                    time.sleep(min(60, 2 ** i) * (0.5 + random.random()))
+
+        if len(batches) == 1:
+            res = [run(batches[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(batches))) as exe:
+                res = list(exe.map(run, batches))
+        return np.concatenate([np.array(embds) for embds, _ in res], axis=0), sum([cnt for _, cnt in res])
+
     def encode_queries(self, text: str):
         raise NotImplementedError("Please implement encode method!")
 
@@ -101,6 +188,9 @@ class OpenAIEmbed(Base):
 
     def encode(self, texts: list, batch_size=32):
         texts = [truncate(t, 8191) for t in texts]
+        return self._dispatch(texts, batch_size, self._encode_batch)
+
+    def _encode_batch(self, texts):
         res = self.client.embeddings.create(input=texts,
                                             model=self.model_name)
         return np.array([d.embedding for d in res.data]
@@ -122,6 +212,9 @@ class LocalAIEmbed(Base):
         self.model_name = model_name.split("___")[0]
 
     def encode(self, texts: list, batch_size=32):
+        return self._dispatch(texts, batch_size, self._encode_batch)
+
+    def _encode_batch(self, texts):
         res = self.client.embeddings.create(input=texts, model=self.model_name)
         return (
             np.array([d.embedding for d in res.data]),
@@ -154,28 +247,28 @@ class QWenEmbed(Base):
         self.model_name = model_name
 
     def encode(self, texts: list, batch_size=10):
-        import dashscope
         batch_size = min(batch_size, 4)
         try:
-            res = []
-            token_count = 0
             texts = [truncate(t, 2048) for t in texts]
-            for i in range(0, len(texts), batch_size):
-                resp = dashscope.TextEmbedding.call(
-                    model=self.model_name,
-                    input=texts[i:i + batch_size],
-                    text_type="document"
-                )
-                embds = [[] for _ in range(len(resp["output"]["embeddings"]))]
-                for e in resp["output"]["embeddings"]:
-                    embds[e["text_index"]] = e["embedding"]
-                res.extend(embds)
-                token_count += resp["usage"]["total_tokens"]
-            return np.array(res), token_count
+            return self._dispatch(texts, batch_size, self._encode_batch)
         except Exception as e:
             raise Exception("Account abnormal. Please ensure it's on good standing to use QWen's "+self.model_name)
         return np.array([]), 0
 
+    def _encode_batch(self, texts):
+        import dashscope
+        resp = dashscope.TextEmbedding.call(
+            model=self.model_name,
+            input=texts,
+            text_type="document"
+        )
+        if resp.status_code != 200:
+            raise Exception("{} {}".format(resp.status_code, resp.message))
+        embds = [[] for _ in range(len(resp["output"]["embeddings"]))]
+        for e in resp["output"]["embeddings"]:
+            embds[e["text_index"]] = e["embedding"]
+        return np.array(embds), resp["usage"]["total_tokens"]
+
     def encode_queries(self, text):
         try:
             resp = dashscope.TextEmbedding.call(
@@ -196,14 +289,12 @@ class ZhipuEmbed(Base):
         self.model_name = model_name
 
     def encode(self, texts: list, batch_size=32):
-        arr = []
-        tks_num = 0
-        for txt in texts:
-            res = self.client.embeddings.create(input=txt,
-                                                model=self.model_name)
-            arr.append(res.data[0].embedding)
-            tks_num += res.usage.total_tokens
-        return np.array(arr), tks_num
+        return self._dispatch(texts, 1, self._encode_batch)
+
+    def _encode_batch(self, texts):
+        res = self.client.embeddings.create(input=texts[0],
+                                            model=self.model_name)
+        return np.array([res.data[0].embedding]), res.usage.total_tokens
 
     def encode_queries(self, text):
         res = self.client.embeddings.create(input=text,
@@ -217,14 +308,12 @@ class OllamaEmbed(Base):
         self.model_name = model_name
 
     def encode(self, texts: list, batch_size=32):
-        arr = []
-        tks_num = 0
-        for txt in texts:
-            res = self.client.embeddings(prompt=txt,
-                                         model=self.model_name)
-            arr.append(res["embedding"])
-            tks_num += 128
-        return np.array(arr), tks_num
+        return self._dispatch(texts, 1, self._encode_batch)
+
+    def _encode_batch(self, texts):
+        res = self.client.embeddings(prompt=texts[0],
+                                     model=self.model_name)
+        return np.array([res["embedding"]]), 128
 
     def encode_queries(self, text):
         res = self.client.embeddings(prompt=text,
@@ -272,6 +361,9 @@ class XinferenceEmbed(Base):
         self.model_name = model_name
 
     def encode(self, texts: list, batch_size=32):
+        return self._dispatch(texts, batch_size, self._encode_batch)
+
+    def _encode_batch(self, texts):
         res = self.client.embeddings.create(input=texts,
                                             model=self.model_name)
         return np.array([d.embedding for d in res.data]
@@ -325,14 +417,19 @@ class JinaEmbed(Base):
         }
         self.model_name = model_name
 
-    def encode(self, texts: list, batch_size=None):
+    def encode(self, texts: list, batch_size=32):
         texts = [truncate(t, 8196) for t in texts]
+        return self._dispatch(texts, batch_size, self._encode_batch)
+
+    def _encode_batch(self, texts):
         data = {
             "model": self.model_name,
             "input": texts,
             'encoding_type': 'float'
         }
-        res = requests.post(self.base_url, headers=self.headers, json=data).json()
+        res = requests.post(self.base_url, headers=self.headers, json=data)
+        res.raise_for_status()
+        res = res.json()
         return np.array([d["embedding"] for d in res["data"]]), res["usage"]["total_tokens"]
 
     def encode_queries(self, text):
@@ -389,6 +486,9 @@ class MistralEmbed(Base):
 
     def encode(self, texts: list, batch_size=32):
         texts = [truncate(t, 8196) for t in texts]
+        return self._dispatch(texts, batch_size, self._encode_batch)
+
+    def _encode_batch(self, texts):
         res = self.client.embeddings(input=texts,
                                             model=self.model_name)
         return np.array([d.embedding for d in res.data]
@@ -413,20 +513,18 @@ class BedrockEmbed(Base):
 
     def encode(self, texts: list, batch_size=32):
         texts = [truncate(t, 8196) for t in texts]
-        embeddings = []
-        token_count = 0
-        for text in texts:
-            if self.model_name.split('.')[0] == 'amazon':
-                body = {"inputText": text}
-            elif self.model_name.split('.')[0] == 'cohere':
-                body = {"texts": [text], "input_type": 'search_document'}
+        return self._dispatch(texts, 1, self._encode_batch)
 
-            response = self.client.invoke_model(modelId=self.model_name, body=json.dumps(body))
-            model_response = json.loads(response["body"].read())
-            embeddings.extend([model_response["embedding"]])
-            token_count += num_tokens_from_string(text)
+    def _encode_batch(self, texts):
+        text = texts[0]
+        if self.model_name.split('.')[0] == 'amazon':
+            body = {"inputText": text}
+        elif self.model_name.split('.')[0] == 'cohere':
+            body = {"texts": [text], "input_type": 'search_document'}
 
-        return np.array(embeddings), token_count
+        response = self.client.invoke_model(modelId=self.model_name, body=json.dumps(body))
+        model_response = json.loads(response["body"].read())
+        return np.array([model_response["embedding"]]), num_tokens_from_string(text)
 
     def encode_queries(self, text):
 
@@ -451,6 +549,9 @@ class GeminiEmbed(Base):
         
     def encode(self, texts: list, batch_size=32):
         texts = [truncate(t, 2048) for t in texts]
+        return self._dispatch(texts, batch_size, self._encode_batch)
+
+    def _encode_batch(self, texts):
         token_count = sum(num_tokens_from_string(text) for text in texts)
         result = genai.embed_content(
             model=self.model_name,
@@ -488,7 +589,10 @@ class NvidiaEmbed(Base):
         if model_name == "snowflake/arctic-embed-l":
             self.base_url = "https://ai.api.nvidia.com/v1/retrieval/snowflake/arctic-embed-l/embeddings"
 
-    def encode(self, texts: list, batch_size=None):
+    def encode(self, texts: list, batch_size=32):
+        return self._dispatch(texts, batch_size, self._encode_batch)
+
+    def _encode_batch(self, texts):
         payload = {
             "input": texts,
             "input_type": "query",
@@ -496,7 +600,9 @@ class NvidiaEmbed(Base):
             "encoding_format": "float",
             "truncate": "END",
         }
-        res = requests.post(self.base_url, headers=self.headers, json=payload).json()
+        res = requests.post(self.base_url, headers=self.headers, json=payload)
+        res.raise_for_status()
+        res = res.json()
         return (
             np.array([d["embedding"] for d in res["data"]]),
             res["usage"]["total_tokens"],
@@ -535,6 +641,9 @@ class CoHereEmbed(Base):
         self.model_name = model_name
 
     def encode(self, texts: list, batch_size=32):
+        return self._dispatch(texts, batch_size, self._encode_batch)
+
+    def _encode_batch(self, texts):
         res = self.client.embed(
             texts=texts,
             model=self.model_name,
@@ -593,12 +702,17 @@ class SILICONFLOWEmbed(Base):
         self.model_name = model_name
 
     def encode(self, texts: list, batch_size=32):
+        return self._dispatch(texts, batch_size, self._encode_batch)
+
+    def _encode_batch(self, texts):
         payload = {
             "model": self.model_name,
             "input": texts,
             "encoding_format": "float",
         }
-        res = requests.post(self.base_url, json=payload, headers=self.headers).json()
+        res = requests.post(self.base_url, json=payload, headers=self.headers)
+        res.raise_for_status()
+        res = res.json()
         return (
             np.array([d["embedding"] for d in res["data"]]),
             res["usage"]["total_tokens"],
@@ -622,6 +736,9 @@ class ReplicateEmbed(Base):
         self.client = Client(api_token=key)
 
     def encode(self, texts: list, batch_size=32):
+        return self._dispatch(texts, batch_size, self._encode_batch)
+
+    def _encode_batch(self, texts):
         res = self.client.run(self.model_name, input={"texts": json.dumps(texts)})
         return np.array(res), sum([num_tokens_from_string(text) for text in texts])
 
@@ -641,6 +758,9 @@ class BaiduYiyanEmbed(Base):
         self.model_name = model_name
 
     def encode(self, texts: list, batch_size=32):
+        return self._dispatch(texts, batch_size, self._encode_batch)
+
+    def _encode_batch(self, texts):
         res = self.client.do(model=self.model_name, texts=texts).body
         return (
             np.array([r["embedding"] for r in res["data"]]),
@@ -663,6 +783,9 @@ class VoyageEmbed(Base):
         self.model_name = model_name
 
     def encode(self, texts: list, batch_size=32):
+        return self._dispatch(texts, batch_size, self._encode_batch)
+
+    def _encode_batch(self, texts):
         res = self.client.embed(
             texts=texts, model=self.model_name, input_type="document"
         )
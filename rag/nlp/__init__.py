@@ -14,6 +14,7 @@
 #  limitations under the License.
 #
 
+import codecs
 import random
 from collections import Counter
 
@@ -45,22 +46,65 @@ all_codecs = [
 ]
 
 
+BOMS = [(codecs.BOM_UTF32_LE, "utf_32"), (codecs.BOM_UTF32_BE, "utf_32"), (codecs.BOM_UTF8, "utf-8"),
+        (codecs.BOM_UTF16_LE, "utf_16"), (codecs.BOM_UTF16_BE, "utf_16")]
+CODEC_SAMPLE = 64 * 1024
+
+
+def is_utf8(blob, block=1024 * 1024):
+    dec = codecs.getincrementaldecoder("utf-8")()
+    mv = memoryview(blob)
+    try:
+        for i in range(0, len(blob), block):
+            dec.decode(mv[i: i + block])
+        dec.decode(b"", final=True)
+        return True
+    except UnicodeDecodeError:
+        return False
+
+
 def find_codec(blob):
+    """BOM, then UTF-8 validity, then chardet over the first CODEC_SAMPLE bytes."""
+    if blob.isascii():
+        return "utf-8"
+    for bom, c in BOMS:
+        if blob.startswith(bom):
+            return c
+    if is_utf8(blob):
+        return "utf-8"
+
+    sample = blob[:CODEC_SAMPLE]
+    try:
+        from chardet.universaldetector import UniversalDetector
+        detector = UniversalDetector()
+        for i in range(0, len(sample), 4096):
+            detector.feed(sample[i: i + 4096])
+            if detector.done:
+                break
+        detector.close()
+        c = detector.result.get("encoding")
+        if c and detector.result.get("confidence", 0) > 0.8:
+            c = codecs.lookup(c).name
+            if c in ["gb2312", "gbk"]:
+                c = "gb18030"
+            if c == "ascii":
+                c = "utf-8"
+            codecs.getincrementaldecoder(c)().decode(sample)
+            return c
+    except Exception as e:
+        pass
+
     global all_codecs
     for c in all_codecs:
         try:
-            blob[:1024].decode(c)
-            return c
-        except Exception as e:
-            pass
-        try:
-            blob.decode(c)
+            codecs.getincrementaldecoder(c)().decode(sample)
             return c
         except Exception as e:
             pass
 
     return "utf-8"
 
+
 QUESTION_PATTERN = [
     r"第([零一二三四五六七八九十百0-9]+)问",
     r"第([零一二三四五六七八九十百0-9]+)条",
@@ -228,8 +272,19 @@ def tokenize(d, t, eng):
     d["content_sm_ltks"] = rag_tokenizer.fine_grained_tokenize(d["content_ltks"])
 
 
+def tokenize_docs(docs, texts, eng):
+    """Same as `tokenize` for each doc and its text, on the tokenizer's process pool."""
+    txts = []
+    for d, t in zip(docs, texts):
+        d["content_with_weight"] = t
+        txts.append(re.sub(r"</?(table|td|caption|tr|th)( [^<>]{0,12})?>", " ", t))
+    for d, (ltks, sm_ltks) in zip(docs, rag_tokenizer.tokenize_batch(txts)):
+        d["content_ltks"] = ltks
+        d["content_sm_ltks"] = sm_ltks
+
+
 def tokenize_chunks(chunks, doc, eng, pdf_parser=None):
-    res = []
+    res, texts = [], []
     # wrap up as es documents
     for ck in chunks:
         if len(ck.strip()) == 0:continue
@@ -242,46 +297,48 @@ def tokenize_chunks(chunks, doc, eng, pdf_parser=None):
                 ck = pdf_parser.remove_tag(ck)
             except NotImplementedError as e:
                 pass
-        tokenize(d, ck, eng)
         res.append(d)
+        texts.append(ck)
+    tokenize_docs(res, texts, eng)
     return res
 
 
 def tokenize_chunks_docx(chunks, doc, eng, images):
-    res = []
+    res, texts = [], []
     # wrap up as es documents
     for ck, image in zip(chunks, images):
         if len(ck.strip()) == 0:continue
         print("--", ck)
         d = copy.deepcopy(doc)
         d["image"] = image
-        tokenize(d, ck, eng)
         res.append(d)
+        texts.append(ck)
+    tokenize_docs(res, texts, eng)
     return res
 
 
 def tokenize_table(tbls, doc, eng, batch_size=10):
-    res = []
+    res, texts = [], []
     # add tables
     for (img, rows), poss in tbls:
         if not rows:
             continue
         if isinstance(rows, str):
             d = copy.deepcopy(doc)
-            tokenize(d, rows, eng)
-            d["content_with_weight"] = rows
             if img: d["image"] = img
             if poss: add_positions(d, poss)
             res.append(d)
+            texts.append(rows)
             continue
         de = "; " if eng else "； "
         for i in range(0, len(rows), batch_size):
             d = copy.deepcopy(doc)
             r = de.join(rows[i:i + batch_size])
-            tokenize(d, r, eng)
             d["image"] = img
             add_positions(d, poss)
             res.append(d)
+            texts.append(r)
+    tokenize_docs(res, texts, eng)
     return res
 
 
@@ -0,0 +1,122 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Micro-benchmarks of the text pipeline.
+
+    python -m rag.nlp.benchmark import [-n 5]
+    python -m rag.nlp.benchmark normalize [--mb 1]
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from api.utils.file_utils import get_project_base_directory
+
+# Runs in a fresh interpreter: what importing rag.nlp costs, and what the
+# first tokenize/term weighting costs once the lazy resources get loaded.
+_IMPORT_PROBE = """
+import json, resource, sys, time
+t0 = time.perf_counter()
+from rag.nlp import search, rag_tokenizer
+from rag.nlp.term_weight import Dealer
+t1 = time.perf_counter()
+rss1 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+tw = Dealer()
+t2 = time.perf_counter()
+rag_tokenizer.tokenize("多校划片就是一个小区对应多个小学初中 and some english words")
+t3 = time.perf_counter()
+tw.weights(["多校划片", "小区", "english"])
+t4 = time.perf_counter()
+rss2 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({"import": t1 - t0, "init": t2 - t1, "first_tokenize": t3 - t2,
+                  "first_weights": t4 - t3, "import_rss_mb": rss1 / 1024., "rss_mb": rss2 / 1024.}))
+"""
+
+
+def bench_import(n):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([get_project_base_directory(), env.get("PYTHONPATH", "")])
+    runs = []
+    for _ in range(n):
+        out = subprocess.run([sys.executable, "-c", _IMPORT_PROBE], env=env, check=True,
+                             capture_output=True, text=True).stdout
+        runs.append(json.loads(out.strip().split("\n")[-1]))
+    for k in runs[0].keys():
+        v = [r[k] for r in runs]
+        unit = "MB" if k.endswith("_mb") else "s"
+        print("%-16s median %8.3f%s  min %8.3f%s" % (k, np.median(v), unit, np.min(v), unit))
+
+
+def _strQ2B_loop(ustring):
+    # The per-character implementation RagTokenizer._strQ2B used to have.
+    rstring = ""
+    for uchar in ustring:
+        inside_code = ord(uchar)
+        if inside_code == 0x3000:
+            inside_code = 0x0020
+        else:
+            inside_code -= 0xfee0
+        if inside_code < 0x0020 or inside_code > 0x7e:
+            rstring += uchar
+        else:
+            rstring += chr(inside_code)
+    return rstring
+
+
+def bench_normalize(mb):
+    from hanziconv import HanziConv
+    from rag.nlp import rag_tokenizer
+
+    rnd = random.Random(0)
+    alphabet = [chr(c) for c in range(0x20, 0x7f)] + [chr(c) for c in range(0xff00, 0xff5f)] + \
+        ["\u3000"] + [chr(c) for c in rag_tokenizer.T2S_TABLE] + [chr(c) for c in range(0x4e00, 0x4e00 + 2000)]
+    text, size = [], 0
+    while size < mb * 1024 * 1024:
+        ln = "".join(rnd.choice(alphabet) for _ in range(200))
+        text.append(ln)
+        size += len(ln.encode("utf-8"))
+    text = "\n".join(text)
+    print("corpus: %.2fMB, %d chars" % (len(text.encode("utf-8")) / 1024. / 1024., len(text)))
+
+    for name, old, new in [("strQ2B", _strQ2B_loop, rag_tokenizer.tokenizer._strQ2B),
+                           ("tradi2simp", HanziConv.toSimplified, rag_tokenizer.tokenizer._tradi2simp)]:
+        t0 = time.perf_counter()
+        a = old(text)
+        t1 = time.perf_counter()
+        b = new(text)
+        t2 = time.perf_counter()
+        assert a == b, "%s differs from the reference implementation" % name
+        print("%-12s loop %8.3fs  translate %8.4fs  x%.0f" % (name, t1 - t0, t2 - t1, (t1 - t0) / max(t2 - t1, 1e-9)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="bench", required=True)
+    p = sub.add_parser("import", help="import time and first-use latency of rag.nlp, in fresh processes")
+    p.add_argument("-n", type=int, default=5, help="number of runs")
+    p = sub.add_parser("normalize", help="full-width to half-width and traditional to simplified conversion")
+    p.add_argument("--mb", type=float, default=1, help="corpus size in MB")
+    args = parser.parse_args()
+    if args.bench == "import":
+        bench_import(args.n)
+    elif args.bench == "normalize":
+        bench_normalize(args.mb)
@@ -19,101 +19,165 @@ import math
 import re
 import logging
 import copy
+import threading
+import numpy as np
+from timeit import default_timer as timer
+from cachetools import TTLCache
 from elasticsearch_dsl import Q
 
 from rag.nlp import rag_tokenizer, term_weight, synonym
+from rag.settings import QUERY_ANALYSIS_CACHE_SIZE, QUERY_ANALYSIS_CACHE_TTL
+from rag.utils.redis_conn import REDIS_CONN
+
+SPECIAL_CHAR = re.compile(r"([:\{\}/\[\]\-\*\"\(\)\|\+~\^])")
+BLANKS = re.compile(r"[ \t]+")
+ALPHA = re.compile(r"[a-zA-Z]+$")
+PUNCT = re.compile(r"[ :\r\n\t,，。？?/`!！&\^%%]+")
+WWW = [
+    (re.compile(r"是*(什么样的|哪家|一下|那家|请问|啥样|咋样了|什么时候|何时|何地|何人|是否|是不是|多少|哪里|怎么|哪儿|怎么样|如何|哪些|是啥|啥是|啊|吗|呢|吧|咋|什么|有没有|呀)是*", re.IGNORECASE), ""),
+    (re.compile(r"(^| )(what|who|how|which|where|why)('re|'s)? ", re.IGNORECASE), " "),
+    (re.compile(r"(^| )('s|'re|is|are|were|was|do|does|did|don't|doesn't|didn't|has|have|be|there|you|me|your|my|mine|just|please|may|i|should|would|wouldn't|will|won't|done|go|for|with|so|the|a|an|by|i'm|it's|he's|she's|they|they're|you're|as|by|on|in|at|up|out|down|of) ", re.IGNORECASE), " ")
+]
+TK_QUOTES = re.compile(r"[ \\\"'^]")
+TK_SINGLE = re.compile(r"^[a-z0-9]$")
+TK_SIGN = re.compile(r"^[\+-]")
+NO_FINE_GRAINED = re.compile(r"[0-9a-z\.\+#_\*-]+$")
+SM_PUNCT = re.compile(r"[ ,\./;'\[\]\\`~!@#$%\^&\*\(\)=\+_<>\?:\"\{\}\|，。；‘’【】、！￥……（）——《》？：“”-]+")
+KW_QUOTES = re.compile(r"[ \\\"']+")
+ALNUM_SPACE = re.compile(r"[0-9a-z ]+$")
+
 
 class EsQueryer:
     def __init__(self, es):
         self.tw = term_weight.Dealer()
         self.es = es
-        self.syn = synonym.Dealer()
+        self.syn = synonym.Dealer(REDIS_CONN if REDIS_CONN.is_alive() else None)
         self.flds = ["ask_tks^10", "ask_small_tks"]
+        # question() is asked the same thing several times per chat turn
+        self.lock = threading.Lock()
+        self.cache = TTLCache(maxsize=QUERY_ANALYSIS_CACHE_SIZE, ttl=QUERY_ANALYSIS_CACHE_TTL)
+        self.hits = 0
+        self.misses = 0
+        self.timings = {}
 
     @staticmethod
     def subSpecialChar(line):
-        return re.sub(r"([:\{\}/\[\]\-\*\"\(\)\|\+~\^])", r"\\\1", line).strip()
+        return SPECIAL_CHAR.sub(r"\\\1", line).strip()
 
     @staticmethod
     def isChinese(line):
-        arr = re.split(r"[ \t]+", line)
+        arr = BLANKS.split(line)
         if len(arr) <= 3:
             return True
         e = 0
         for t in arr:
-            if not re.match(r"[a-zA-Z]+$", t):
+            if not ALPHA.match(t):
                 e += 1
         return e * 1. / len(arr) >= 0.7
 
     @staticmethod
     def rmWWW(txt):
-        patts = [
-            (r"是*(什么样的|哪家|一下|那家|请问|啥样|咋样了|什么时候|何时|何地|何人|是否|是不是|多少|哪里|怎么|哪儿|怎么样|如何|哪些|是啥|啥是|啊|吗|呢|吧|咋|什么|有没有|呀)是*", ""),
-            (r"(^| )(what|who|how|which|where|why)('re|'s)? ", " "),
-            (r"(^| )('s|'re|is|are|were|was|do|does|did|don't|doesn't|didn't|has|have|be|there|you|me|your|my|mine|just|please|may|i|should|would|wouldn't|will|won't|done|go|for|with|so|the|a|an|by|i'm|it's|he's|she's|they|they're|you're|as|by|on|in|at|up|out|down|of) ", " ")
-        ]
-        for r, p in patts:
-            txt = re.sub(r, p, txt, flags=re.IGNORECASE)
+        for r, p in WWW:
+            txt = r.sub(p, txt)
         return txt
 
-    def question(self, txt, tbl="qa", min_match="60%"):
-        txt = re.sub(
-            r"[ :\r\n\t,，。？?/`!！&\^%%]+",
-            " ",
-            rag_tokenizer.tradi2simp(
-                rag_tokenizer.strQ2B(
-                    txt.lower()))).strip()
-        txt = EsQueryer.rmWWW(txt)
+    @staticmethod
+    def normalize(txt):
+        txt = PUNCT.sub(" ", rag_tokenizer.tradi2simp(rag_tokenizer.strQ2B(txt.lower()))).strip()
+        return EsQueryer.rmWWW(txt)
+
+    def question(self, txt, tbl="qa", min_match="60%", tenant_id=None):
+        """
+        The ES query and the keywords of `txt`, expanded with the synonyms of
+        `tenant_id`. Both are cached per question and synonym version;
+        callers get their own copy of the query to add filters to.
+        """
+        k = (txt, tbl, min_match, tuple(self.flds), tenant_id, self.syn.version_of(tenant_id))
+        with self.lock:
+            v = self.cache.get(k)
+            if v is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if v is None:
+            phases = {}
+            v = self.analyze(txt, min_match, phases, tenant_id)
+            with self.lock:
+                self.cache[k] = v
+                for p, t in phases.items():
+                    self.timings[p] = self.timings.get(p, 0) + t
+            logging.debug("Query analysis %s: %s" % (json.dumps(txt, ensure_ascii=False),
+                                                      json.dumps({p: "%.6f" % t for p, t in phases.items()})))
+        bqry, keywords = v
+        return copy.deepcopy(bqry), list(keywords)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.cache),
+                    "hit_rate": self.hits / total if total else 0.,
+                    "seconds": {p: round(t, 6) for p, t in self.timings.items()}}
+
+    def analyze(self, txt, min_match, phases, tenant_id=None):
+        """`question` without the cache; the seconds spent per phase are added up in `phases`."""
+        st = timer()
+        txt = EsQueryer.normalize(txt)
+        phases["normalize"] = timer() - st
 
         if not self.isChinese(txt):
+            st = timer()
             tks = rag_tokenizer.tokenize(txt).split(" ")
             tks_w = self.tw.weights(tks)
-            tks_w = [(re.sub(r"[ \\\"'^]", "", tk), w) for tk, w in tks_w]
-            tks_w = [(re.sub(r"^[a-z0-9]$", "", tk), w) for tk, w in tks_w if tk]
-            tks_w = [(re.sub(r"^[\+-]", "", tk), w) for tk, w in tks_w if tk]
+            phases["weight"] = timer() - st
+            st = timer()
+            tks_w = [(TK_QUOTES.sub("", tk), w) for tk, w in tks_w]
+            tks_w = [(TK_SINGLE.sub("", tk), w) for tk, w in tks_w if tk]
+            tks_w = [(TK_SIGN.sub("", tk), w) for tk, w in tks_w if tk]
             q = ["{}^{:.4f}".format(tk, w) for tk, w in tks_w if tk]
             for i in range(1, len(tks_w)):
                 q.append("\"%s %s\"^%.4f" % (tks_w[i - 1][0], tks_w[i][0], max(tks_w[i - 1][1], tks_w[i][1])*2))
             if not q:
                 q.append(txt)
-            return Q("bool",
+            bqry = Q("bool",
                      must=Q("query_string", fields=self.flds,
                             type="best_fields", query=" ".join(q),
                             boost=1)#, minimum_should_match=min_match)
-                     ), list(set([t for t in txt.split(" ") if t]))
+                     )
+            phases["build"] = timer() - st
+            return bqry, list(set([t for t in txt.split(" ") if t]))
 
         def need_fine_grained_tokenize(tk):
             if len(tk) < 3:
                 return False
-            if re.match(r"[0-9a-z\.\+#_\*-]+$", tk):
+            if NO_FINE_GRAINED.match(tk):
                 return False
             return True
 
+        phases["weight"] = phases["expand"] = 0
         qs, keywords = [], []
         for tt in self.tw.split(txt)[:256]:  # .split(" "):
             if not tt:
                 continue
+            st = timer()
             keywords.append(tt)
             twts = self.tw.weights([tt])
-            syns = self.syn.lookup(tt)
+            phases["weight"] += timer() - st
+            st = timer()
+            syns = self.syn.lookup(tt, tenant_id)
             if syns: keywords.extend(syns)
             logging.info(json.dumps(twts, ensure_ascii=False))
             tms = []
             for tk, w in sorted(twts, key=lambda x: x[1] * -1):
                 sm = rag_tokenizer.fine_grained_tokenize(tk).split(" ") if need_fine_grained_tokenize(tk) else []
-                sm = [
-                    re.sub(
-                        r"[ ,\./;'\[\]\\`~!@#$%\^&\*\(\)=\+_<>\?:\"\{\}\|，。；‘’【】、！￥……（）——《》？：“”-]+",
-                        "",
-                        m) for m in sm]
+                sm = [SM_PUNCT.sub("", m) for m in sm]
                 sm = [EsQueryer.subSpecialChar(m) for m in sm if len(m) > 1]
                 sm = [m for m in sm if len(m) > 1]
 
-                keywords.append(re.sub(r"[ \\\"']+", "", tk))
+                keywords.append(KW_QUOTES.sub("", tk))
                 keywords.extend(sm)
                 if len(keywords) >= 12: break
 
-                tk_syns = self.syn.lookup(tk)
+                tk_syns = self.syn.lookup(tk, tenant_id)
                 tk = EsQueryer.subSpecialChar(tk)
                 if tk.find(" ") > 0:
                     tk = "\"%s\"" % tk
@@ -129,7 +193,7 @@ class EsQueryer:
 
             if len(twts) > 1:
                 tms += f" (\"%s\"~4)^1.5" % (" ".join([t for t, _ in twts]))
-            if re.match(r"[0-9a-z ]+$", tt):
+            if ALNUM_SPACE.match(tt):
                 tms = f"(\"{tt}\" OR \"%s\")" % rag_tokenizer.tokenize(tt)
 
             syns = " OR ".join(
@@ -138,7 +202,9 @@ class EsQueryer:
                 tms = f"({tms})^5 OR ({syns})^0.7"
 
             qs.append(tms)
+            phases["expand"] += timer() - st
 
+        st = timer()
         flds = copy.deepcopy(self.flds)
         mst = []
         if qs:
@@ -147,33 +213,59 @@ class EsQueryer:
                   query=" OR ".join([f"({t})" for t in qs if t]), boost=1, minimum_should_match=min_match)
             )
 
-        return Q("bool",
+        bqry = Q("bool",
                  must=mst,
-                 ), list(set(keywords))
+                 )
+        phases["build"] = timer() - st
+        return bqry, list(set(keywords))
 
     def hybrid_similarity(self, avec, bvecs, atks, btkss, tkweight=0.3,
                           vtweight=0.7):
         from sklearn.metrics.pairwise import cosine_similarity as CosineSimilarity
-        import numpy as np
-        sims = CosineSimilarity([avec], bvecs)
+        sims = CosineSimilarity(np.asarray([avec]), np.asarray(bvecs))
         tksim = self.token_similarity(atks, btkss)
         return np.array(sims[0]) * vtweight + \
             np.array(tksim) * tkweight, tksim, sims[0]
 
     def token_similarity(self, atks, btkss):
+        """
+        Vectorized `similarity` of the query tokens against every candidate.
+
+        Only the query side needs term weights; a candidate contributes the set
+        of its terms (given directly as a `set`, or as tokens), so candidates are reduced to a hit matrix over the query
+        terms and scored with a single matrix-vector product.
+        """
         def toDict(tks):
             d = {}
             if isinstance(tks, str):
                 tks = tks.split(" ")
-            for t, c in self.tw.weights(tks):
+            for t, c in zip(*self.tw.weights_array(tks)):
                 if t not in d:
                     d[t] = 0
                 d[t] += c
             return d
 
         atks = toDict(atks)
-        btkss = [toDict(tks) for tks in btkss]
-        return [self.similarity(atks, btks) for btks in btkss]
+        col = {t: i for i, t in enumerate(atks.keys())}
+        qw = np.array(list(atks.values()), dtype=float)
+        hits = np.zeros((len(btkss), len(col)))
+        dlen = np.zeros(len(btkss))
+        for i, tks in enumerate(btkss):
+            if isinstance(tks, set):
+                terms = tks
+            else:
+                if isinstance(tks, str):
+                    tks = tks.split(" ")
+                terms = self.tw.terms(tks)
+            dlen[i] = len(terms)
+            for t in terms:
+                if t in col:
+                    hits[i, col[t]] = 1
+
+        s = 1e-9 + hits.dot(qw)
+        q = 1e-9 + qw.sum()
+        n = np.maximum(1, np.sqrt(np.log10(np.maximum(1, np.maximum(len(col), dlen)))))
+        return s / q / n
 
     def similarity(self, qtwt, dtwt):
         if isinstance(dtwt, type("")):
@@ -17,16 +17,26 @@
 import copy
 import datrie
 import math
+import multiprocessing
 import os
 import re
 import string
 import sys
-from hanziconv import HanziConv
-from huggingface_hub import snapshot_download
-from nltk import word_tokenize
-from nltk.stem import PorterStemmer, WordNetLemmatizer
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from hanziconv.charmap import simplified_charmap, traditional_charmap
 from api.utils.file_utils import get_project_base_directory
 
+# 全角转半角: U+3000 and U+FF00..U+FF5E to their ASCII counterparts
+Q2B_TABLE = {0x3000: 0x20, **{c: c - 0xfee0 for c in range(0xff00, 0xff5f)}}
+# 繁体转简体, character by character like HanziConv.toSimplified (first match wins)
+T2S_TABLE = {}
+for _t, _s in zip(traditional_charmap, simplified_charmap):
+    if ord(_t) not in T2S_TABLE and _t != _s:
+        T2S_TABLE[ord(_t)] = _s
+
 
 class RagTokenizer:
     def key_(self, line):
@@ -35,8 +45,9 @@ class RagTokenizer:
     def rkey_(self, line):
         return str(("DD" + (line[::-1].lower())).encode("utf-8"))[2:-1]
 
-    def loadDict_(self, fnm):
+    def loadDict_(self, fnm, trie=None):
         print("[HUQIE]:Build trie", fnm, file=sys.stderr)
+        trie = self.trie_ if trie is None else trie
         try:
             of = open(fnm, "r", encoding='utf-8')
             while True:
@@ -47,10 +58,10 @@ class RagTokenizer:
                 line = re.split(r"[ \t]", line)
                 k = self.key_(line[0])
                 F = int(math.log(float(line[1]) / self.DENOMINATOR) + .5)
-                if k not in self.trie_ or self.trie_[k][0] < F:
-                    self.trie_[self.key_(line[0])] = (F, line[2])
-                self.trie_[self.rkey_(line[0])] = 1
-            self.trie_.save(fnm + ".trie")
+                if k not in trie or trie[k][0] < F:
+                    trie[self.key_(line[0])] = (F, line[2])
+                trie[self.rkey_(line[0])] = 1
+            trie.save(fnm + ".trie")
             of.close()
         except Exception as e:
             print("[HUQIE]:Faild to build trie, ", fnm, e, file=sys.stderr)
@@ -58,23 +69,60 @@ class RagTokenizer:
     def __init__(self, debug=False):
         self.DEBUG = debug
         self.DENOMINATOR = 1000000
-        self.trie_ = datrie.Trie(string.printable)
         self.DIR_ = os.path.join(get_project_base_directory(), "rag/res", "huqie")
-
-        self.stemmer = PorterStemmer()
-        self.lemmatizer = WordNetLemmatizer()
+        # The dictionary and NLTK are loaded on first use, not on import.
+        self._trie = None
+        self._stemmer, self._lemmatizer = None, None
+        self._lock = threading.RLock()
+        # bumped by every user dictionary, which forked workers would not see
+        self.dict_version = 0
 
         self.SPLIT_CHAR = r"([ ,\.<>/?;'\[\]\\`!@#$%^&*\(\)\{\}\|_+=《》，。？、；‘’：“”【】~！￥%……（）——-]+|[a-z\.-]+|[0-9,\.-]+)"
+        # Every chunk and every query goes through here; the same keys and spans
+        # come up again and again.
+        self.key_ = lru_cache(maxsize=200000)(self.key_)
+        self.dp_ = lru_cache(maxsize=100000)(self.dp_)
+        self.span_ = lru_cache(maxsize=100000)(self.span_)
+
+    def loadTrie_(self):
         try:
-            self.trie_ = datrie.Trie.load(self.DIR_ + ".txt.trie")
-            return
+            return datrie.Trie.load(self.DIR_ + ".txt.trie")
         except Exception as e:
             print("[HUQIE]:Build default trie", file=sys.stderr)
-            self.trie_ = datrie.Trie(string.printable)
-
-        self.loadDict_(self.DIR_ + ".txt")
+        trie = datrie.Trie(string.printable)
+        self.loadDict_(self.DIR_ + ".txt", trie)
+        return trie
+
+    @property
+    def trie_(self):
+        if self._trie is None:
+            with self._lock:
+                if self._trie is None:
+                    self._trie = self.loadTrie_()
+        return self._trie
+
+    @trie_.setter
+    def trie_(self, trie):
+        self._trie = trie
+
+    @property
+    def stemmer(self):
+        if self._stemmer is None:
+            from nltk.stem import PorterStemmer
+            self._stemmer = PorterStemmer()
+        return self._stemmer
+
+    @property
+    def lemmatizer(self):
+        if self._lemmatizer is None:
+            from nltk.stem import WordNetLemmatizer
+            self._lemmatizer = WordNetLemmatizer()
+        return self._lemmatizer
 
     def loadUserDict(self, fnm):
+        self.dict_version += 1
+        self.dp_.cache_clear()
+        self.span_.cache_clear()
         try:
             self.trie_ = datrie.Trie.load(fnm + ".trie")
             return
@@ -83,25 +131,17 @@ class RagTokenizer:
         self.loadDict_(fnm)
 
     def addUserDict(self, fnm):
+        self.dict_version += 1
+        self.dp_.cache_clear()
+        self.span_.cache_clear()
         self.loadDict_(fnm)
 
     def _strQ2B(self, ustring):
         """把字符串全角转半角"""
-        rstring = ""
-        for uchar in ustring:
-            inside_code = ord(uchar)
-            if inside_code == 0x3000:
-                inside_code = 0x0020
-            else:
-                inside_code -= 0xfee0
-            if inside_code < 0x0020 or inside_code > 0x7e:  # 转完之后不是半角字符返回原来的字符
-                rstring += uchar
-            else:
-                rstring += chr(inside_code)
-        return rstring
+        return ustring.translate(Q2B_TABLE)
 
     def _tradi2simp(self, line):
-        return HanziConv.toSimplified(line)
+        return line.translate(T2S_TABLE)
 
     def dfs_(self, chars, s, preTks, tkslist):
         MAX_L = 10
@@ -152,6 +192,73 @@ class RagTokenizer:
 
         return self.dfs_(chars, s + 1, preTks, tkslist)
 
+    def dp_(self, chars):
+        """
+        Rank the segmentations of `chars` the way `sortTks_` ranks everything
+        `dfs_` enumerates, without enumerating them.
+
+        `score_` is (30 + L + F) / n, so for a given token count n and count L
+        of multi-char tokens only the largest frequency sum F matters. The DP
+        runs from the end of `chars` over (position, trailing single chars),
+        the state `dfs_` prunes on, and keeps the two best suffixes for each
+        (n, L); ties keep `dfs_`'s order, shorter tokens first.
+        Returns the ranked (tokens, score) list, holding at least the two
+        best, and the number of paths `dfs_` would produce.
+        """
+        N = len(chars)
+
+        def has_prefix(t):
+            return self.trie_.has_keys_with_prefix(self.key_(t))
+
+        # suffix[s][c]: ({(n, L): [(F, ends), ...]}, number of paths)
+        suffix = [None] * (N + 1)
+        suffix[N] = [({(0, 0): [(0, ())]}, 1)] * 4
+        for s in range(N - 1, -1, -1):
+            suffix[s] = []
+            for c in range(4):
+                S = s + 1
+                if s + 2 <= N and has_prefix(chars[s]) and not has_prefix(chars[s:s + 2]):
+                    S = s + 2
+                if c == 3 and has_prefix(chars[s - 1:s + 1]):
+                    S = s + 2
+
+                branches = []
+                for e in range(S, N + 1):
+                    k = self.key_(chars[s:e])
+                    if e > s + 1 and not self.trie_.has_keys_with_prefix(k):
+                        break
+                    if k in self.trie_:
+                        branches.append((e, self.trie_[k][0]))
+                if not branches:
+                    k = self.key_(chars[s])
+                    branches.append((s + 1, self.trie_[k][0] if k in self.trie_ else -12))
+
+                table, cnt = {}, 0
+                for e, f in branches:
+                    multi = 1 if e - s > 1 else 0
+                    sub, sub_cnt = suffix[e][0 if multi else min(c + 1, 3)]
+                    cnt += sub_cnt
+                    for (n, L), paths in sub.items():
+                        table.setdefault((n + 1, L + multi), []).extend((F + f, (e,) + ends) for F, ends in paths)
+                for key, paths in table.items():
+                    table[key] = sorted(paths, key=lambda p: (-p[0], p[1]))[:2]
+                suffix[s].append((table, cnt))
+
+        table, cnt = suffix[0][0]
+        res = []
+        for paths in table.values():
+            for _, ends in paths:
+                tfts, s = [], 0
+                for e in ends:
+                    t = chars[s:e]
+                    k = self.key_(t)
+                    tfts.append((t, self.trie_[k] if k in self.trie_ else (-12, '')))
+                    s = e
+                tks, score = self.score_(tfts)
+                res.append((ends, tks, score))
+        res = sorted(res, key=lambda x: (-x[2], x[0]))
+        return [(tks, score) for _, tks, score in res], cnt
+
     def freq(self, tk):
         k = self.key_(tk)
         if k not in self.trie_:
@@ -263,6 +370,7 @@ class RagTokenizer:
         line = self._tradi2simp(line)
         zh_num = len([1 for c in line if is_chinese(c)])
         if zh_num == 0:
+            from nltk import word_tokenize
             return " ".join([self.stemmer.stem(self.lemmatizer.lemmatize(t)) for t in word_tokenize(line)])
 
         arr = re.split(self.SPLIT_CHAR, line)
@@ -272,49 +380,51 @@ class RagTokenizer:
                     r"[a-z\.-]+$", L) or re.match(r"[0-9\.-]+$", L):
                 res.append(L)
                 continue
-            # print(L)
-
-            # use maxforward for the first time
-            tks, s = self.maxForward_(L)
-            tks1, s1 = self.maxBackward_(L)
-            if self.DEBUG:
-                print("[FW]", tks, s)
-                print("[BW]", tks1, s1)
-
-            diff = [0 for _ in range(max(len(tks1), len(tks)))]
-            for i in range(min(len(tks1), len(tks))):
-                if tks[i] != tks1[i]:
-                    diff[i] = 1
-
-            if s1 > s:
-                tks = tks1
-
-            i = 0
-            while i < len(tks):
-                s = i
-                while s < len(tks) and diff[s] == 0:
-                    s += 1
-                if s == len(tks):
-                    res.append(" ".join(tks[i:]))
-                    break
-                if s > i:
-                    res.append(" ".join(tks[i:s]))
-
-                e = s
-                while e < len(tks) and e - s < 5 and diff[e] == 1:
-                    e += 1
-
-                tkslist = []
-                self.dfs_("".join(tks[s:e + 1]), 0, [], tkslist)
-                res.append(" ".join(self.sortTks_(tkslist)[0][0]))
-
-                i = e + 1
+            res.extend(self.span_(L))
 
         res = " ".join(self.english_normalize_(res))
         if self.DEBUG:
             print("[TKS]", self.merge_(res))
         return self.merge_(res)
 
+    def span_(self, L):
+        # use maxforward for the first time
+        tks, s = self.maxForward_(L)
+        tks1, s1 = self.maxBackward_(L)
+        if self.DEBUG:
+            print("[FW]", tks, s)
+            print("[BW]", tks1, s1)
+
+        diff = [0 for _ in range(max(len(tks1), len(tks)))]
+        for i in range(min(len(tks1), len(tks))):
+            if tks[i] != tks1[i]:
+                diff[i] = 1
+
+        if s1 > s:
+            tks = tks1
+
+        res = []
+        i = 0
+        while i < len(tks):
+            s = i
+            while s < len(tks) and diff[s] == 0:
+                s += 1
+            if s == len(tks):
+                res.append(" ".join(tks[i:]))
+                break
+            if s > i:
+                res.append(" ".join(tks[i:s]))
+
+            e = s
+            while e < len(tks) and e - s < 5 and diff[e] == 1:
+                e += 1
+
+            res.append(" ".join(self.dp_("".join(tks[s:e + 1]))[0][0][0]))
+
+            i = e + 1
+
+        return tuple(res)
+
     def fine_grained_tokenize(self, tks):
         tks = tks.split(" ")
         zh_num = len([1 for c in tks if c and is_chinese(c[0])])
@@ -329,15 +439,14 @@ class RagTokenizer:
             if len(tk) < 3 or re.match(r"[0-9,\.-]+$", tk):
                 res.append(tk)
                 continue
-            tkslist = []
             if len(tk) > 10:
-                tkslist.append(tk)
-            else:
-                self.dfs_(tk, 0, [], tkslist)
-            if len(tkslist) < 2:
                 res.append(tk)
                 continue
-            stk = self.sortTks_(tkslist)[1][0]
+            tkslist, cnt = self.dp_(tk)
+            if cnt < 2:
+                res.append(tk)
+                continue
+            stk = tkslist[1][0]
             if len(stk) == len(tk):
                 stk = tk
             else:
@@ -398,6 +507,69 @@ addUserDict = tokenizer.addUserDict
 tradi2simp = tokenizer._tradi2simp
 strQ2B = tokenizer._strQ2B
 
+TOKENIZE_WORKERS = int(os.environ.get("TOKENIZE_WORKERS", min(8, os.cpu_count() or 1)))
+# Below this many texts the round trip to the workers costs more than it saves.
+TOKENIZE_BATCH_MIN = int(os.environ.get("TOKENIZE_BATCH_MIN", 32))
+_pool = None
+_pool_lock = threading.Lock()
+# dictionary version the workers forked with
+_pool_dict_version = None
+
+
+# Module level so that only the text, not the tokenizer, is pickled to workers.
+def _tokenize(txt):
+    return tokenizer.tokenize(txt)
+
+
+def _tokenize_pair(txt):
+    tks = tokenizer.tokenize(txt)
+    return tks, tokenizer.fine_grained_tokenize(tks)
+
+
+def init_pool():
+    """
+    Start the tokenizer workers. They fork from this process and share its
+    dictionary copy-on-write, so this must be called before any thread is
+    started; without it `tokenize_batch` tokenizes in turn.
+    """
+    global _pool, _pool_dict_version
+    with _pool_lock:
+        if _pool is None and TOKENIZE_WORKERS > 1 and not multiprocessing.current_process().daemon:
+            # load before forking so that the workers share it
+            tokenizer.trie_
+            if "fork" in multiprocessing.get_all_start_methods():
+                ctx = multiprocessing.get_context("fork")
+            else:
+                ctx = multiprocessing.get_context()
+            _pool = ProcessPoolExecutor(max_workers=TOKENIZE_WORKERS, mp_context=ctx)
+            _pool_dict_version = tokenizer.dict_version
+            # with fork all workers are started by the first submit
+            _pool.submit(_tokenize, "").result()
+        return _pool
+
+
+def tokenize_batch(texts, fine_grained=True):
+    """
+    Tokenize `texts` on a pool of `TOKENIZE_WORKERS` processes.
+
+    Returns (content_ltks, content_sm_ltks) pairs in the order of `texts`, or
+    just the content_ltks strings if `fine_grained` is False. The pool is only
+    used if `init_pool` started it and no user dictionary was loaded since.
+    """
+    global _pool
+    fn = _tokenize_pair if fine_grained else _tokenize
+    texts = list(texts)
+    pool = _pool
+    if pool is None or _pool_dict_version != tokenizer.dict_version or len(texts) < TOKENIZE_BATCH_MIN:
+        return [fn(t) for t in texts]
+    try:
+        return list(pool.map(fn, texts, chunksize=max(1, len(texts) // (TOKENIZE_WORKERS * 4))))
+    except BrokenProcessPool as e:
+        print("[HUQIE]:Tokenizer pool broke, ", e, file=sys.stderr)
+        with _pool_lock:
+            _pool = None
+        return [fn(t) for t in texts]
+
 if __name__ == '__main__':
     tknzr = RagTokenizer(debug=True)
     # huqie.addUserDict("/tmp/tmp.new.tks.dict")
@@ -22,7 +22,7 @@ from elasticsearch_dsl import Q, Search
 from typing import List, Optional, Dict, Union
 from dataclasses import dataclass
 
-from rag.settings import es_logger
+from rag.settings import es_logger, ES_RESCORE, ES_RESCORE_TERM_K
 from rag.utils import rmSpace
 from rag.nlp import rag_tokenizer, query, is_english
 import numpy as np
@@ -53,6 +53,7 @@ class Dealer:
         aggregation: Union[List, Dict, None] = None
         keywords: Optional[List[str]] = None
         group_docs: List[List] = None
+        scores: Optional[Dict] = None
 
     def _vector(self, txt, emb_mdl, sim=0.8, topk=10):
         qv, c = emb_mdl.encode_queries(txt)
@@ -64,6 +65,36 @@ class Dealer:
             "query_vector": [float(v) for v in qv]
         }
 
+    def _rescore(self, bqry, knn, rescore):
+        """
+        Rescore the top `window` hits with the same blend `rerank` computes:
+        saturated text score weighted by `tkweight` plus vector cosine weighted
+        by `vtweight`, so that only the final page has to leave Elasticsearch.
+        """
+        tqry = bqry.to_dict()
+        tqry["bool"].pop("boost", None)
+        return {
+            "window_size": rescore["window"],
+            "query": {
+                "rescore_query": {
+                    "script_score": {
+                        "query": {"bool": {"must": [{"match_all": {"boost": 0}}], "should": [tqry]}},
+                        "script": {
+                            "source": "double t = _score / (_score + params.k); "
+                                      "double v = doc[params.field].size() == 0 ? 0 : "
+                                      "Math.max(0, cosineSimilarity(params.query_vector, params.field)); "
+                                      "return params.tkweight * t + params.vtweight * v;",
+                            "params": {"k": ES_RESCORE_TERM_K, "field": knn["field"],
+                                       "query_vector": knn["query_vector"],
+                                       "tkweight": rescore["tkweight"], "vtweight": rescore["vtweight"]}
+                        }
+                    }
+                },
+                "query_weight": 0,
+                "rescore_query_weight": 1
+            }
+        }
+
     def _add_filters(self, bqry, req):
         if req.get("kb_ids"):
             bqry.filter.append(Q("terms", kb_id=req["kb_ids"]))
@@ -81,7 +112,7 @@ class Dealer:
 
     def search(self, req, idxnm, emb_mdl=None, highlight=False):
         qst = req.get("question", "")
-        bqry, keywords = self.qryr.question(qst, min_match="30%")
+        bqry, keywords = self.qryr.question(qst, min_match="30%", tenant_id=req.get("tenant_id"))
         bqry = self._add_filters(bqry, req)
         bqry.boost = 0.05
 
@@ -91,7 +122,10 @@ class Dealer:
         ps = int(req.get("size", topk))
         src = req.get("fields", ["docnm_kwd", "content_ltks", "kb_id", "img_id", "title_tks", "important_kwd",
                                  "image_id", "doc_id", "q_512_vec", "q_768_vec", "position_int", "knowledge_graph_kwd",
-                                 "q_1024_vec", "q_1536_vec", "available_int", "content_with_weight"])
+                                 "q_1024_vec", "q_1536_vec", "available_int", "content_with_weight",
+                                 "content_terms"])
+        if not req.get("fetch_vectors", True):
+            src = [f for f in src if not f.endswith("_vec")]
 
         s = s.query(bqry)[pg * ps:(pg + 1) * ps]
         s = s.highlight("content_ltks")
@@ -133,17 +167,21 @@ class Dealer:
             if not highlight and "highlight" in s:
                 del s["highlight"]
             q_vec = s["knn"]["query_vector"]
+            if req.get("rescore"):
+                s["rescore"] = self._rescore(bqry, s["knn"], req["rescore"])
         es_logger.info("【Q】: {}".format(json.dumps(s)))
         res = self.es.search(deepcopy(s), idxnm=idxnm, timeout="600s", src=src)
         es_logger.info("TOTAL: {}".format(self.es.getTotal(res)))
         if self.es.getTotal(res) == 0 and "knn" in s:
-            bqry, _ = self.qryr.question(qst, min_match="10%")
+            bqry, _ = self.qryr.question(qst, min_match="10%", tenant_id=req.get("tenant_id"))
             if req.get("doc_ids"):
                 bqry = Q("bool", must=[])
             bqry = self._add_filters(bqry, req)
             s["query"] = bqry.to_dict()
             s["knn"]["filter"] = bqry.to_dict()
             s["knn"]["similarity"] = 0.17
+            if req.get("rescore"):
+                s["rescore"] = self._rescore(bqry, s["knn"], req["rescore"])
             res = self.es.search(s, idxnm=idxnm, timeout="600s", src=src)
             es_logger.info("【Q】: {}".format(json.dumps(s)))
 
@@ -166,7 +204,8 @@ class Dealer:
             aggregation=aggs,
             highlight=self.getHighlight(res, keywords, "content_with_weight"),
             field=self.getFields(res, src),
-            keywords=list(kwds)
+            keywords=list(kwds),
+            scores={d["_id"]: d["_score"] for d in res["hits"]["hits"]}
         )
 
     def getAggregation(self, res, g):
@@ -205,6 +244,9 @@ class Dealer:
         for d in self.es.getSource(sres):
             m = {n: d.get(n) for n in flds if d.get(n) is not None}
             for n, v in m.items():
+                if n.endswith("_vec"):
+                    m[n] = np.asarray(v, dtype=np.float32)
+                    continue
                 if isinstance(v, type([])):
                     m[n] = "\t".join([str(vv) if not isinstance(
                         vv, list) else "\t".join([str(vvv) for vvv in vv]) for vv in v])
@@ -218,10 +260,47 @@ class Dealer:
                 res[d["id"]] = m
         return res
 
+    def content_terms(self, content_ltks):
+        # Rerank sees content_ltks after getFields' rmSpace, so split those tokens.
+        return self.qryr.tw.terms_field(rmSpace(content_ltks).split(" "))
+
+    def rank_terms(self, sres, cfield="content_ltks"):
+        """
+        Term sets of the candidates for token similarity. Chunks indexed with
+        `content_terms` are read back from it; others are split here.
+        """
+        res = []
+        for i in sres.ids:
+            if isinstance(sres.field[i].get("important_kwd", []), str):
+                sres.field[i]["important_kwd"] = [sres.field[i]["important_kwd"]]
+            title_tks = [t for t in sres.field[i].get("title_tks", "").split(" ") if t]
+            important_kwd = sres.field[i].get("important_kwd", [])
+            tw = sres.field[i].get("content_terms") if cfield == "content_ltks" else None
+            if tw:
+                res.append(self.qryr.tw.field_terms(tw) | self.qryr.tw.terms(title_tks + important_kwd))
+                continue
+            res.append(sres.field[i][cfield].split(" ") + title_tks + important_kwd)
+        return res
+
     @staticmethod
     def trans2floats(txt):
         return [float(t) for t in txt.split("\t")]
 
+    @staticmethod
+    def vector_of(field, dim):
+        v = field.get("q_%d_vec" % dim)
+        if v is None:
+            return np.zeros(dim, dtype=np.float32)
+        if isinstance(v, str):
+            return np.array(Dealer.trans2floats(v), dtype=np.float32)
+        return v
+
+    def fetch_vectors(self, ids, idxnm, dim):
+        fld = "q_%d_vec" % dim
+        s = Search().query(Q("ids", values=ids))[0:len(ids)].to_dict()
+        res = self.es.search(s, idxnm=idxnm, timeout="600s", src=[fld])
+        return {d["id"]: np.asarray(d[fld], dtype=np.float32) for d in self.es.getSource(res) if d.get(fld)}
+
     def insert_citations(self, answer, chunks, chunk_v,
                          embd_mdl, tkweight=0.1, vtweight=0.9):
         assert len(chunks) == len(chunk_v)
@@ -309,23 +388,12 @@ class Dealer:
     def rerank(self, sres, query, tkweight=0.3,
                vtweight=0.7, cfield="content_ltks"):
         _, keywords = self.qryr.question(query)
-        ins_embd = [
-            Dealer.trans2floats(
-                sres.field[i].get("q_%d_vec" % len(sres.query_vector), "\t".join(["0"] * len(sres.query_vector)))) for i in sres.ids]
-        if not ins_embd:
+        if not sres.ids:
             return [], [], []
+        dim = len(sres.query_vector)
+        ins_embd = np.stack([Dealer.vector_of(sres.field[i], dim) for i in sres.ids])
 
-        for i in sres.ids:
-            if isinstance(sres.field[i].get("important_kwd", []), str):
-                sres.field[i]["important_kwd"] = [sres.field[i]["important_kwd"]]
-        ins_tw = []
-        for i in sres.ids:
-            content_ltks = sres.field[i][cfield].split(" ")
-            title_tks = [t for t in sres.field[i].get("title_tks", "").split(" ") if t]
-            important_kwd = sres.field[i].get("important_kwd", [])
-            tks = content_ltks + title_tks + important_kwd
-            ins_tw.append(tks)
-
+        ins_tw = self.rank_terms(sres, cfield)
         sim, tksim, vtsim = self.qryr.hybrid_similarity(sres.query_vector,
                                                         ins_embd,
                                                         keywords,
@@ -347,7 +415,7 @@ class Dealer:
             tks = content_ltks + title_tks + important_kwd
             ins_tw.append(tks)
 
-        tksim = self.qryr.token_similarity(keywords, ins_tw)
+        tksim = self.qryr.token_similarity(keywords, self.rank_terms(sres, cfield))
         vtsim,_ = rerank_mdl.similarity(" ".join(keywords), [rmSpace(" ".join(tks)) for tks in ins_tw])
 
         return tkweight*np.array(tksim) + vtweight*vtsim, tksim, vtsim
@@ -367,14 +435,34 @@ class Dealer:
         req = {"kb_ids": kb_ids, "doc_ids": doc_ids, "size": page_size*RERANK_PAGE_LIMIT,
                "question": question, "vector": True, "topk": top,
                "similarity": similarity_threshold,
-               "available_int": 1}
-        if page > RERANK_PAGE_LIMIT:
+               "available_int": 1, "tenant_id": tenant_id}
+        rescore = ES_RESCORE and page <= RERANK_PAGE_LIMIT and not rerank_mdl
+        if page > RERANK_PAGE_LIMIT or rescore:
             req["page"] = page
             req["size"] = page_size
+        if rescore:
+            req["rescore"] = {"window": page_size * RERANK_PAGE_LIMIT,
+                              "tkweight": 1 - vector_similarity_weight, "vtweight": vector_similarity_weight}
+        # Only the built-in rerank needs every candidate's vector; otherwise
+        # just those of the returned chunks are fetched afterwards.
+        req["fetch_vectors"] = page <= RERANK_PAGE_LIMIT and not rerank_mdl and not rescore
         sres = self.search(req, index_name(tenant_id), embd_mdl, highlight)
         ranks["total"] = sres.total
+        dim = len(sres.query_vector)
 
-        if page <= RERANK_PAGE_LIMIT:
+        if rescore:
+            # Already blended and ordered by Elasticsearch. The similarities of
+            # the returned page are computed as rerank does, so the threshold
+            # means the same as without rescore.
+            vecs = self.fetch_vectors(sres.ids, index_name(tenant_id), dim) if sres.ids else {}
+            for i in sres.ids:
+                if i in vecs:
+                    sres.field[i]["q_%d_vec" % dim] = vecs[i]
+            sim, tsim, vsim = self.rerank(
+                sres, question, 1 - vector_similarity_weight, vector_similarity_weight)
+            idx = list(range(len(sres.ids)))
+            req["fetch_vectors"] = True
+        elif page <= RERANK_PAGE_LIMIT:
             if rerank_mdl:
                 sim, tsim, vsim = self.rerank_by_model(rerank_mdl,
                     sres, question, 1 - vector_similarity_weight, vector_similarity_weight)
@@ -386,9 +474,10 @@ class Dealer:
             sim = tsim = vsim = [1]*len(sres.ids)
             idx = list(range(len(sres.ids)))
 
-        dim = len(sres.query_vector)
         for i in idx:
             if sim[i] < similarity_threshold:
+                if rescore:
+                    continue
                 break
             if len(ranks["chunks"]) >= page_size:
                 if aggs:
@@ -409,7 +498,7 @@ class Dealer:
                 "similarity": sim[i],
                 "vector_similarity": vsim[i],
                 "term_similarity": tsim[i],
-                "vector": self.trans2floats(sres.field[id].get("q_%d_vec" % dim, "\t".join(["0"] * dim))),
+                "vector": self.vector_of(sres.field[id], dim),
                 "positions": sres.field[id].get("position_int", "").split("\t")
             }
             if highlight:
@@ -427,6 +516,13 @@ class Dealer:
             if dnm not in ranks["doc_aggs"]:
                 ranks["doc_aggs"][dnm] = {"doc_id": did, "count": 0}
             ranks["doc_aggs"][dnm]["count"] += 1
+        if not req["fetch_vectors"] and ranks["chunks"]:
+            vecs = self.fetch_vectors([c["chunk_id"] for c in ranks["chunks"]], index_name(tenant_id), dim)
+            for c in ranks["chunks"]:
+                if c["chunk_id"] in vecs:
+                    c["vector"] = vecs[c["chunk_id"]]
+        for c in ranks["chunks"]:
+            c["vector"] = c["vector"].tolist()
         ranks["doc_aggs"] = [{"doc_name": k,
                               "doc_id": v["doc_id"],
                               "count": v["count"]} for k,
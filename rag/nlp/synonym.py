@@ -14,62 +14,163 @@
 #  limitations under the License.
 #
 
+import hashlib
 import json
 import os
 import time
 import logging
 import re
+import threading
+from types import MappingProxyType
+
+from cachetools import TTLCache
 
 from api.utils.file_utils import get_project_base_directory
+from rag.settings import SYNONYM_REFRESH_INTERVAL, SYNONYM_TENANT_CACHE_SIZE, SYNONYM_TENANT_CACHE_TTL
+
+EMPTY = MappingProxyType({})
 
 
 class Dealer:
-    def __init__(self, redis=None):
+    """
+    Synonyms looked up on the query path. The built-in synonym.json can be
+    overridden by a global set in Redis ("kevin_synonyms") and extended per
+    tenant ("kevin_synonyms:<tenant_id>"). Redis sets are polled by a
+    background thread every SYNONYM_REFRESH_INTERVAL seconds, so changes
+    apply within that delay, and swapped in as read-only dicts: a lookup
+    never waits for a reload. Tenant sets are loaded on their first lookup
+    and dropped SYNONYM_TENANT_CACHE_TTL seconds after their last one.
+    """
+    KEY = "kevin_synonyms"
 
-        self.lookup_num = 100000000
-        self.load_tm = time.time() - 1000000
-        self.dictionary = None
-        path = os.path.join(get_project_base_directory(), "rag/res", "synonym.json")
-        try:
-            self.dictionary = json.load(open(path, 'r'))
-        except Exception as e:
-            logging.warn("Missing synonym.json")
-            self.dictionary = {}
+    def __init__(self, redis=None, refresh_interval=SYNONYM_REFRESH_INTERVAL):
+        # synonym.json is read on first lookup
+        self._dictionary = None
+        self._lock = threading.Lock()
+        # tenant id -> (digest, set)
+        self._tenants = TTLCache(maxsize=SYNONYM_TENANT_CACHE_SIZE, ttl=SYNONYM_TENANT_CACHE_TTL)
+        self._digest = ""
+        self._pending = set()
+        self._wake = threading.Event()
+        # bumped whenever the global set is swapped; see version_of
+        self.version = 0
 
         if not redis:
             logging.warning(
                 "Realtime synonym is disabled, since no redis connection.")
-        if not len(self.dictionary.keys()):
-            logging.warning(f"Fail to load synonym")
 
         self.redis = redis
-        self.load()
+        self.refresh_interval = refresh_interval
+        self._thread = None
 
-    def load(self):
-        if not self.redis:
-            return
+    @property
+    def dictionary(self):
+        if self._dictionary is None:
+            with self._lock:
+                if self._dictionary is None:
+                    path = os.path.join(get_project_base_directory(), "rag/res", "synonym.json")
+                    try:
+                        d = json.load(open(path, 'r'))
+                    except Exception as e:
+                        logging.warn("Missing synonym.json")
+                        d = {}
+                    if not len(d.keys()):
+                        logging.warning(f"Fail to load synonym")
+                    self._dictionary = MappingProxyType(d)
+        return self._dictionary
 
-        if self.lookup_num < 100:
-            return
-        tm = time.time()
-        if tm - self.load_tm < 3600:
-            return
+    @dictionary.setter
+    def dictionary(self, d):
+        self._dictionary = MappingProxyType(dict(d))
+        self.version += 1
+
+    def _key(self, tenant_id=None):
+        return f"{self.KEY}:{tenant_id}" if tenant_id else self.KEY
 
-        self.load_tm = time.time()
-        self.lookup_num = 0
-        d = self.redis.get("kevin_synonyms")
-        if not d:
+    def load(self, tenant_id=None):
+        """Fetch and parse one synonym set from Redis; a no-op when it is unchanged."""
+        if not self.redis:
+            return
+        d = self.redis.get(self._key(tenant_id))
+        digest = hashlib.md5(d.encode("utf-8")).hexdigest() if d else None
+        if tenant_id:
+            with self._lock:
+                old = self._tenants.get(tenant_id)
+            if old and old[0] == digest:
+                return
+        elif self._digest == digest:
             return
         try:
-            d = json.loads(d)
-            self.dictionary = d
+            d = MappingProxyType(json.loads(d)) if d else EMPTY
         except Exception as e:
             logging.error("Fail to load synonym!" + str(e))
+            return
+        if tenant_id:
+            with self._lock:
+                self._tenants[tenant_id] = (digest, d)
+        else:
+            self._digest = digest
+            if d:
+                self.dictionary = d
+
+    def version_of(self, tenant_id=None):
+        """
+        What the synonyms of `tenant_id` derive from, for caches of derived
+        results: the global version and the digest of the tenant's set, None
+        if it has none or is not loaded yet. Other tenants' loads don't change it.
+        """
+        if not tenant_id:
+            return self.version, None
+        with self._lock:
+            e = self._tenants.get(tenant_id)
+        return self.version, e[0] if e else None
+
+    def _refresh(self, tenant_ids):
+        for tid in tenant_ids:
+            try:
+                self.load(tid)
+            except Exception as e:
+                logging.warning("Fail to refresh synonym %s: %s" % (self._key(tid), e))
+
+    def _refresh_loop(self):
+        last = 0
+        while True:
+            self._wake.clear()
+            with self._lock:
+                todo, self._pending = self._pending, set()
+                if not last or 0 < self.refresh_interval <= time.time() - last:
+                    last = time.time()
+                    todo |= {None} | set(self._tenants.keys())
+            self._refresh(todo)
+            # woken early by tenants looked up for the first time
+            self._wake.wait(self.refresh_interval if self.refresh_interval > 0 else None)
+
+    def _start(self):
+        # started by the first lookup, so processes that never search don't poll
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._refresh_loop, name="synonym-refresh", daemon=True)
+                self._thread.start()
+
+    def _tenant(self, tenant_id):
+        with self._lock:
+            e = self._tenants.get(tenant_id)
+            if e is not None:
+                # a lookup keeps the set for another SYNONYM_TENANT_CACHE_TTL
+                self._tenants[tenant_id] = e
+            elif self.redis:
+                # loaded in the background; meanwhile only the global set applies
+                self._pending.add(tenant_id)
+                self._wake.set()
+        return e[1] if e else EMPTY
 
-    def lookup(self, tk):
-        self.lookup_num += 1
-        self.load()
-        res = self.dictionary.get(re.sub(r"[ \t]+", " ", tk.lower()), [])
+    def lookup(self, tk, tenant_id=None):
+        if self.redis and self._thread is None:
+            self._start()
+        tk = re.sub(r"[ \t]+", " ", tk.lower())
+        res = self._tenant(tenant_id).get(tk) if tenant_id else None
+        if res is None:
+            res = self.dictionary.get(tk, [])
         if isinstance(res, str):
             res = [res]
         return res
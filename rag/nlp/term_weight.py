@@ -18,11 +18,35 @@ import math
 import json
 import re
 import os
+import threading
 import numpy as np
+from functools import lru_cache
 from rag.nlp import rag_tokenizer
+from rag.utils.mmap_dict import MmapDict
 from api.utils.file_utils import get_project_base_directory
 
 
+def load_dict(fnm):
+    res = {}
+    f = open(fnm, "r")
+    while True:
+        l = f.readline()
+        if not l:
+            break
+        arr = l.replace("\n", "").split("\t")
+        if len(arr) < 2:
+            res[arr[0]] = 0
+        else:
+            res[arr[0]] = int(arr[1])
+
+    c = 0
+    for _, v in res.items():
+        c += v
+    if c == 0:
+        return set(res.keys())
+    return res
+
+
 class Dealer:
     def __init__(self):
         self.stop_words = set(["请问",
@@ -56,37 +80,45 @@ class Dealer:
                                "哪些",
                                "啥",
                                "相关"])
+        # ner.json and term.freq are loaded on first use, memory-mapped.
+        self._ne, self._df = None, None
+        self._lock = threading.Lock()
 
-        def load_dict(fnm):
-            res = {}
-            f = open(fnm, "r")
-            while True:
-                l = f.readline()
-                if not l:
-                    break
-                arr = l.replace("\n", "").split("\t")
-                if len(arr) < 2:
-                    res[arr[0]] = 0
-                else:
-                    res[arr[0]] = int(arr[1])
-
-            c = 0
-            for _, v in res.items():
-                c += v
-            if c == 0:
-                return set(res.keys())
-            return res
+        # Splitting a token into terms only depends on the token itself.
+        self.token_terms = lru_cache(maxsize=200000)(
+            lambda tk: tuple(self.tokenMerge(self.pretoken(tk, True))))
+        # So is the unnormalized weight of a term.
+        self.term_weight = lru_cache(maxsize=200000)(self.term_weight)
 
+    def load_res_(self):
         fnm = os.path.join(get_project_base_directory(), "rag/res")
-        self.ne, self.df = {}, {}
+        ne, df = {}, {}
         try:
-            self.ne = json.load(open(os.path.join(fnm, "ner.json"), "r"))
+            ne = MmapDict.open(os.path.join(fnm, "ner.json"), lambda f: json.load(open(f, "r")))
         except Exception as e:
             print("[WARNING] Load ner.json FAIL!")
         try:
-            self.df = load_dict(os.path.join(fnm, "term.freq"))
+            df = MmapDict.open(os.path.join(fnm, "term.freq"), load_dict)
         except Exception as e:
             print("[WARNING] Load term.freq FAIL!")
+        self._df = df
+        self._ne = ne
+
+    def ensure_res_(self):
+        if self._ne is None:
+            with self._lock:
+                if self._ne is None:
+                    self.load_res_()
+
+    @property
+    def ne(self):
+        self.ensure_res_()
+        return self._ne
+
+    @property
+    def df(self):
+        self.ensure_res_()
+        return self._df
 
     def pretoken(self, txt, num=False, stpwd=True):
         patt = [
@@ -158,12 +190,23 @@ class Dealer:
                 tks.append(t)
         return tks
 
-    def weights(self, tks):
-        def skill(t):
-            if t not in self.sk:
-                return 1
-            return 6
+    def terms(self, tks):
+        """The distinct terms `weights(tks)` would weigh, without weighing them."""
+        res = set()
+        for tk in tks:
+            res.update(self.token_terms(tk))
+        return res
 
+    def terms_field(self, tks):
+        """`terms(tks)`, tab separated, to store with a chunk."""
+        return "\t".join(sorted(self.terms(tks)))
+
+    @staticmethod
+    def field_terms(txt):
+        return set([t for t in txt.split("\t") if t])
+
+    def term_weight(self, t):
+        """IDF x NER x POS weight of a single term, before normalization."""
         def ner(t):
             if re.match(r"[0-9,.]{2,}$", t):
                 return 2
@@ -221,15 +264,14 @@ class Dealer:
 
         def idf(s, N): return math.log10(10 + ((N - s + 0.5) / (s + 0.5)))
 
-        tw = []
-        for tk in tks:
-            tt = self.tokenMerge(self.pretoken(tk, True))
-            idf1 = np.array([idf(freq(t), 10000000) for t in tt])
-            idf2 = np.array([idf(df(t), 1000000000) for t in tt])
-            wts = (0.3 * idf1 + 0.7 * idf2) * \
-                np.array([ner(t) * postag(t) for t in tt])
+        return (0.3 * idf(freq(t), 10000000) + 0.7 * idf(df(t), 1000000000)) * (ner(t) * postag(t))
 
-            tw.extend(zip(tt, wts))
+    def weights_array(self, tks):
+        """The terms of `tks` and their normalized weights as a numpy array."""
+        tt = [t for tk in tks for t in self.token_terms(tk)]
+        wts = np.fromiter((self.term_weight(t) for t in tt), dtype=float, count=len(tt))
+        return tt, wts / np.sum(wts)
 
-        S = np.sum([s for _, s in tw])
-        return [(t, s / S) for t, s in tw]
+    def weights(self, tks):
+        tt, wts = self.weights_array(tks)
+        return list(zip(tt, wts))
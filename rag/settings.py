@@ -34,6 +34,55 @@ except Exception as e:
     pass
 DOC_MAXIMUM_SIZE = int(os.environ.get("MAX_CONTENT_LENGTH", 128 * 1024 * 1024))
 
+# Task executor pipeline.
+# Tasks in flight per executor process.
+MAX_CONCURRENT_TASKS = int(os.environ.get("MAX_CONCURRENT_TASKS", "5"))
+# Threads parsing documents into chunks (or building RAPTOR summaries).
+MAX_CONCURRENT_CHUNK_BUILDERS = int(os.environ.get("MAX_CONCURRENT_CHUNK_BUILDERS", "1"))
+# Threads embedding the chunks of a task.
+MAX_CONCURRENT_EMBEDDINGS = int(os.environ.get("MAX_CONCURRENT_EMBEDDINGS", "2"))
+# Threads bulk-inserting the embedded chunks of a task into Elasticsearch.
+MAX_CONCURRENT_INDEXERS = int(os.environ.get("MAX_CONCURRENT_INDEXERS", "2"))
+# Tasks waiting between two stages; bounds the chunks held in memory.
+STAGE_QUEUE_SIZE = int(os.environ.get("STAGE_QUEUE_SIZE", "2"))
+
+# Embedding cache: a local sqlite tier (per host) and an optional Redis tier (shared).
+EMBEDDING_CACHE_ENABLED = os.environ.get("EMBEDDING_CACHE", "1") not in ("0", "false", "False")
+EMBEDDING_CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR", "")
+# About 4KB of disk per row for 1024-dimensional vectors.
+EMBEDDING_CACHE_MAX_ITEMS = int(os.environ.get("EMBEDDING_CACHE_MAX_ITEMS", 100000))
+EMBEDDING_CACHE_REDIS = os.environ.get("EMBEDDING_CACHE_REDIS", "0") in ("1", "true", "True")
+EMBEDDING_CACHE_REDIS_TTL = int(os.environ.get("EMBEDDING_CACHE_REDIS_TTL", 7 * 24 * 3600))
+# Query embeddings: in-process LRU with TTL, shared between API workers through Redis.
+QUERY_EMBEDDING_CACHE_SIZE = int(os.environ.get("QUERY_EMBEDDING_CACHE_SIZE", 10000))
+QUERY_EMBEDDING_CACHE_TTL = int(os.environ.get("QUERY_EMBEDDING_CACHE_TTL", 3600))
+QUERY_EMBEDDING_CACHE_REDIS = os.environ.get("QUERY_EMBEDDING_CACHE_REDIS", "1") in ("1", "true", "True")
+# Analyzed questions (ES query and keywords); the TTL bounds how stale synonyms may get.
+QUERY_ANALYSIS_CACHE_SIZE = int(os.environ.get("QUERY_ANALYSIS_CACHE_SIZE", 10000))
+QUERY_ANALYSIS_CACHE_TTL = int(os.environ.get("QUERY_ANALYSIS_CACHE_TTL", 600))
+# Processes each task executor gets for OCR and layout detection of PDF pages;
+# below 2, or for documents under PDF_PARSER_PARALLEL_PAGES pages, pages are done in turn.
+PDF_PARSER_WORKERS = int(os.environ.get("PDF_PARSER_WORKERS", 0))
+PDF_PARSER_PARALLEL_PAGES = int(os.environ.get("PDF_PARSER_PARALLEL_PAGES", 8))
+# Rendered PDF pages kept decoded per parser; the others wait PNG-compressed on disk.
+PDF_PAGE_CACHE_SIZE = int(os.environ.get("PDF_PAGE_CACHE_SIZE", 4))
+# Intra-op threads of the deepdoc ONNX sessions, 0 for one per core; with PDF page
+# workers about cores / PDF_PARSER_WORKERS. `python -m deepdoc.vision.benchmark threads` measures it.
+ONNX_INTRA_OP_THREADS = int(os.environ.get("ONNX_INTRA_OP_THREADS", 0))
+ONNX_CPU_MEM_ARENA = os.environ.get("ONNX_CPU_MEM_ARENA", "1") in ("1", "true", "True")
+# Load <model>.int8.onnx, made by `python -m deepdoc.vision.quantize`, instead of a model where present.
+ONNX_INT8_MODELS = os.environ.get("ONNX_INT8_MODELS", "1") in ("1", "true", "True")
+# Seconds between reloads of the Redis synonym sets; changes apply within this delay.
+SYNONYM_REFRESH_INTERVAL = int(os.environ.get("SYNONYM_REFRESH_INTERVAL", 3600))
+# Tenant synonym sets kept, and for how long since they were last looked up.
+SYNONYM_TENANT_CACHE_SIZE = int(os.environ.get("SYNONYM_TENANT_CACHE_SIZE", 1000))
+SYNONYM_TENANT_CACHE_TTL = int(os.environ.get("SYNONYM_TENANT_CACHE_TTL", 24 * 3600))
+# Blend token and vector similarity inside Elasticsearch (rescore) instead of
+# pulling every candidate's vector into Python. Only the returned page is
+# scored again in Python, for the similarity threshold and the doc counts.
+ES_RESCORE = str(ES.get("rescore", os.environ.get("ES_RESCORE", "0"))).lower() in ("1", "true")
+ES_RESCORE_TERM_K = float(ES.get("rescore_term_k", os.environ.get("ES_RESCORE_TERM_K", 10)))
+
 # Logger
 LoggerFactory.set_directory(
     os.path.join(
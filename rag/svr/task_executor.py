@@ -21,10 +21,12 @@ import hashlib
 import copy
 import re
 import sys
+import threading
 import time
 import traceback
 from concurrent.futures import ThreadPoolExecutor
 from functools import partial
+from queue import Queue
 
 from api.db.services.file2document_service import File2DocumentService
 from api.settings import retrievaler
@@ -33,16 +35,20 @@ from rag.utils.storage_factory import STORAGE_IMPL
 from api.db.db_models import close_connection
 from rag.settings import database_logger, SVR_QUEUE_NAME
 from rag.settings import cron_logger, DOC_MAXIMUM_SIZE
+from rag.settings import MAX_CONCURRENT_TASKS, MAX_CONCURRENT_CHUNK_BUILDERS, MAX_CONCURRENT_EMBEDDINGS, \
+    MAX_CONCURRENT_INDEXERS, STAGE_QUEUE_SIZE
 from multiprocessing import Pool
 import numpy as np
 from elasticsearch_dsl import Q, Search
 from multiprocessing.context import TimeoutError
 from api.db.services.task_service import TaskService
 from rag.utils.es_conn import ELASTICSEARCH
+from rag.utils.embedding_cache import EmbeddingCache
 from timeit import default_timer as timer
 from rag.utils import rmSpace, findMaxTm, num_tokens_from_string
 
 from rag.nlp import search, rag_tokenizer
+from deepdoc.parser import pdf_parser
 from io import BytesIO
 import pandas as pd
 
@@ -75,11 +81,19 @@ FACTORY = {
 }
 
 CONSUMEER_NAME = "task_consumer_" + ("0" if len(sys.argv) < 2 else sys.argv[1])
-PAYLOAD = None
+UNACKED_ITERATOR = None
+
+task_limiter = threading.BoundedSemaphore(MAX_CONCURRENT_TASKS)
+
+
+class TaskCanceledException(Exception):
+    def __init__(self, msg):
+        super().__init__(msg)
+        self.msg = msg
+
 
 def set_progress(task_id, from_page=0, to_page=-1,
                  prog=None, msg="Processing..."):
-    global PAYLOAD
     if prog is not None and prog < 0:
         msg = "[ERROR]" + msg
     cancel = TaskService.do_cancel(task_id)
@@ -100,41 +114,48 @@ def set_progress(task_id, from_page=0, to_page=-1,
 
     close_connection()
     if cancel:
-        if PAYLOAD:
-            PAYLOAD.ack()
-            PAYLOAD = None
-        os._exit(0)
+        raise TaskCanceledException(msg)
 
 
 def collect():
-    global CONSUMEER_NAME, PAYLOAD
+    global CONSUMEER_NAME, UNACKED_ITERATOR
+    payload = None
     try:
-        PAYLOAD = REDIS_CONN.get_unacked_for(CONSUMEER_NAME, SVR_QUEUE_NAME, "rag_flow_svr_task_broker")
-        if not PAYLOAD:
-            PAYLOAD = REDIS_CONN.queue_consumer(SVR_QUEUE_NAME, "rag_flow_svr_task_broker", CONSUMEER_NAME)
-        if not PAYLOAD:
+        # Messages left pending by a previous run of this consumer are
+        # recovered once, before new ones are read off the stream.
+        if UNACKED_ITERATOR is None:
+            UNACKED_ITERATOR = REDIS_CONN.get_unacked_iterator(SVR_QUEUE_NAME, "rag_flow_svr_task_broker", CONSUMEER_NAME)
+        try:
+            payload = next(UNACKED_ITERATOR)
+        except StopIteration:
+            pass
+        if not payload:
+            payload = REDIS_CONN.queue_consumer(SVR_QUEUE_NAME, "rag_flow_svr_task_broker", CONSUMEER_NAME)
+        if not payload:
             time.sleep(1)
-            return pd.DataFrame()
+            return None, pd.DataFrame()
     except Exception as e:
         cron_logger.error("Get task event from queue exception:" + str(e))
-        return pd.DataFrame()
+        return None, pd.DataFrame()
 
-    msg = PAYLOAD.get_message()
+    msg = payload.get_message()
     if not msg:
-        return pd.DataFrame()
+        return payload, pd.DataFrame()
 
     if TaskService.do_cancel(msg["id"]):
         cron_logger.info("Task {} has been canceled.".format(msg["id"]))
-        return pd.DataFrame()
+        return payload, pd.DataFrame()
     tasks = TaskService.get_tasks(msg["id"])
     if not tasks:
         cron_logger.warn("{} empty task!".format(msg["id"]))
-        return []
+        return payload, pd.DataFrame()
 
     tasks = pd.DataFrame(tasks)
     if msg.get("type", "") == "raptor":
         tasks["task_type"] = "raptor"
-    return tasks
+    if msg.get("byte_range"):
+        tasks["byte_range"] = [tuple(msg["byte_range"])] * len(tasks)
+    return payload, tasks
 
 
 def get_minio_binary(bucket, name):
@@ -176,9 +197,12 @@ def build(row):
     try:
         cks = chunker.chunk(row["name"], binary=binary, from_page=row["from_page"],
                             to_page=row["to_page"], lang=row["language"], callback=callback,
-                            kb_id=row["kb_id"], parser_config=row["parser_config"], tenant_id=row["tenant_id"])
+                            kb_id=row["kb_id"], parser_config=row["parser_config"], tenant_id=row["tenant_id"],
+                            byte_range=row.get("byte_range"))
         cron_logger.info(
             "Chunking({}) {}/{}".format(timer() - st, row["location"], row["name"]))
+    except TaskCanceledException:
+        raise
     except Exception as e:
         callback(-1, f"Internal server error while chunking: %s" %
                      str(e).replace("'", ""))
@@ -196,6 +220,8 @@ def build(row):
     for ck in cks:
         d = copy.deepcopy(doc)
         d.update(ck)
+        if d.get("content_ltks"):
+            d["content_terms"] = retrievaler.content_terms(d["content_ltks"])
         md5 = hashlib.md5()
         md5.update((ck["content_with_weight"] +
                     str(d["doc_id"])).encode("utf-8"))
@@ -237,41 +263,43 @@ def init_kb(row):
 
 
 def embedding(docs, mdl, parser_config={}, callback=None):
-    batch_size = 32
+    # Remote providers split each call into requests of their own size and
+    # keep several of them in flight, so hand them more than one request's worth.
+    batch_size = 256
     tts, cnts = [rmSpace(d["title_tks"]) for d in docs if d.get("title_tks")], [
         re.sub(r"</?(table|td|caption|tr|th)( [^<>]{0,12})?>", " ", d["content_with_weight"]) for d in docs]
-    tk_count = 0
+    # All chunks of a document usually share one title, so each distinct title is
+    # encoded once, in the same batch stream as the contents.
+    uniq_tts, tts_idx = [], []
     if len(tts) == len(cnts):
-        tts_ = np.array([])
-        for i in range(0, len(tts), batch_size):
-            vts, c = mdl.encode(tts[i: i + batch_size])
-            if len(tts_) == 0:
-                tts_ = vts
-            else:
-                tts_ = np.concatenate((tts_, vts), axis=0)
-            tk_count += c
-            callback(prog=0.6 + 0.1 * (i + 1) / len(tts), msg="")
-        tts = tts_
-
-    cnts_ = np.array([])
-    for i in range(0, len(cnts), batch_size):
-        vts, c = mdl.encode(cnts[i: i + batch_size])
-        if len(cnts_) == 0:
-            cnts_ = vts
-        else:
-            cnts_ = np.concatenate((cnts_, vts), axis=0)
-        tk_count += c
-        callback(prog=0.7 + 0.2 * (i + 1) / len(cnts), msg="")
-    cnts = cnts_
+        uniq_tts = list(dict.fromkeys(tts))
+        pos = {t: i for i, t in enumerate(uniq_tts)}
+        tts_idx = np.array([pos[t] for t in tts])
 
-    title_w = float(parser_config.get("filename_embd_weight", 0.1))
-    vects = (title_w * tts + (1 - title_w) *
-             cnts) if len(tts) == len(cnts) else cnts
-
-    assert len(vects) == len(docs)
+    texts = uniq_tts + cnts
+    vects = None
+    tk_count = 0
+    for i in range(0, len(texts), batch_size):
+        vts, c = mdl.encode(texts[i: i + batch_size])
+        if vects is None:
+            vects = np.empty((len(texts), len(vts[0])), dtype=np.float32)
+        vects[i: i + len(vts)] = vts
+        tk_count += c
+        callback(prog=0.6 + 0.3 * (i + 1) / len(texts), msg="")
+
+    cnts = vects[len(uniq_tts):]
+    if uniq_tts:
+        title_w = float(parser_config.get("filename_embd_weight", 0.1))
+        cnts *= (1 - title_w)
+        cnts += title_w * vects[tts_idx]
+
+    assert len(cnts) == len(docs)
+    # Rows stay views of one float32 matrix; they are turned into JSON only
+    # when the bulk request carrying them is serialized.
+    vctr_nm = "q_%d_vec" % vects.shape[1]
     for i, d in enumerate(docs):
-        v = vects[i].tolist()
-        d["q_%d_vec" % len(v)] = v
+        d[vctr_nm] = cnts[i]
+    cron_logger.info("Embedding cache: {}".format(EmbeddingCache().stats()))
     return tk_count
 
 
@@ -311,84 +339,174 @@ def run_raptor(row, chat_mdl, embd_mdl, callback=None):
         d["content_with_weight"] = content
         d["content_ltks"] = rag_tokenizer.tokenize(content)
         d["content_sm_ltks"] = rag_tokenizer.fine_grained_tokenize(d["content_ltks"])
+        d["content_terms"] = retrievaler.content_terms(d["content_ltks"])
         res.append(d)
         tk_count += num_tokens_from_string(content)
     return res, tk_count
 
 
-def main():
-    rows = collect()
-    if len(rows) == 0:
-        return
+class TaskHandle:
+    """One queue message in flight; acked, and its slot freed, once all of its rows are done."""
+
+    def __init__(self, payload, row_count):
+        self.payload = payload
+        self.pending = row_count
+        self.lock = threading.Lock()
+
+    def done(self):
+        with self.lock:
+            self.pending -= 1
+            if self.pending > 0:
+                return
+        if self.payload:
+            self.payload.ack()
+        task_limiter.release()
+
+
+def do_build(item):
+    r, callback = item["row"], item["callback"]
+    try:
+        item["embd_mdl"] = LLMBundle(r["tenant_id"], LLMType.EMBEDDING, llm_name=r["embd_id"], lang=r["language"])
+    except TaskCanceledException:
+        raise
+    except Exception as e:
+        callback(-1, msg=str(e))
+        cron_logger.error(str(e))
+        return False
 
-    for _, r in rows.iterrows():
-        callback = partial(set_progress, r["id"], r["from_page"], r["to_page"])
+    if r.get("task_type", "") == "raptor":
         try:
-            embd_mdl = LLMBundle(r["tenant_id"], LLMType.EMBEDDING, llm_name=r["embd_id"], lang=r["language"])
+            chat_mdl = LLMBundle(r["tenant_id"], LLMType.CHAT, llm_name=r["llm_id"], lang=r["language"])
+            item["cks"], item["tk_count"] = run_raptor(r, chat_mdl, item["embd_mdl"], callback)
+        except TaskCanceledException:
+            raise
         except Exception as e:
             callback(-1, msg=str(e))
             cron_logger.error(str(e))
-            continue
-
-        if r.get("task_type", "") == "raptor":
-            try:
-                chat_mdl = LLMBundle(r["tenant_id"], LLMType.CHAT, llm_name=r["llm_id"], lang=r["language"])
-                cks, tk_count = run_raptor(r, chat_mdl, embd_mdl, callback)
-            except Exception as e:
-                callback(-1, msg=str(e))
-                cron_logger.error(str(e))
-                continue
-        else:
-            st = timer()
-            cks = build(r)
-            cron_logger.info("Build chunks({}): {}".format(r["name"], timer() - st))
-            if cks is None:
-                continue
-            if not cks:
-                callback(1., "No chunk! Done!")
-                continue
-            # TODO: exception handler
-            ## set_progress(r["did"], -1, "ERROR: ")
-            callback(
-                msg="Finished slicing files(%d). Start to embedding the content." %
-                    len(cks))
-            st = timer()
-            try:
-                tk_count = embedding(cks, embd_mdl, r["parser_config"], callback)
-            except Exception as e:
-                callback(-1, "Embedding error:{}".format(str(e)))
-                cron_logger.error(str(e))
-                tk_count = 0
-            cron_logger.info("Embedding elapsed({}): {:.2f}".format(r["name"], timer() - st))
-            callback(msg="Finished embedding({:.2f})! Start to build index!".format(timer() - st))
-
-        init_kb(r)
-        chunk_count = len(set([c["_id"] for c in cks]))
-        st = timer()
-        es_r = ""
-        es_bulk_size = 4
-        for b in range(0, len(cks), es_bulk_size):
-            es_r = ELASTICSEARCH.bulk(cks[b:b + es_bulk_size], search.index_name(r["tenant_id"]))
-            if b % 128 == 0:
-                callback(prog=0.8 + 0.1 * (b + 1) / len(cks), msg="")
-
-        cron_logger.info("Indexing elapsed({}): {:.2f}".format(r["name"], timer() - st))
-        if es_r:
-            callback(-1, f"Insert chunk error, detail info please check ragflow-logs/api/cron_logger.log. Please also check ES status!")
+            return False
+        return True
+
+    st = timer()
+    cks = build(r)
+    cron_logger.info("Build chunks({}): {}".format(r["name"], timer() - st))
+    if cks is None:
+        return False
+    if not cks:
+        callback(1., "No chunk! Done!")
+        return False
+    callback(
+        msg="Finished slicing files(%d). Start to embedding the content." %
+            len(cks))
+    item["cks"] = cks
+    return True
+
+
+def do_embedding(item):
+    r, callback = item["row"], item["callback"]
+    if r.get("task_type", "") == "raptor":
+        return True
+    st = timer()
+    try:
+        item["tk_count"] = embedding(item["cks"], item["embd_mdl"], r["parser_config"], callback)
+    except TaskCanceledException:
+        raise
+    except Exception as e:
+        callback(-1, "Embedding error:{}".format(str(e)))
+        cron_logger.error(str(e))
+        item["tk_count"] = 0
+    cron_logger.info("Embedding elapsed({}): {:.2f}".format(r["name"], timer() - st))
+    callback(msg="Finished embedding({:.2f})! Start to build index!".format(timer() - st))
+    return True
+
+
+def do_index(item):
+    r, callback, cks, tk_count = item["row"], item["callback"], item["cks"], item["tk_count"]
+    init_kb(r)
+    chunk_count = len(set([c["_id"] for c in cks]))
+    st = timer()
+    try:
+        es_r = ELASTICSEARCH.bulk_index(cks, search.index_name(r["tenant_id"]),
+                                        progress=lambda p: callback(prog=0.8 + 0.1 * p, msg=""))
+    except TaskCanceledException:
+        ELASTICSEARCH.deleteByQuery(
+            Q("match", doc_id=r["doc_id"]), idxnm=search.index_name(r["tenant_id"]))
+        raise
+    except Exception as e:
+        es_r = str(e)
+
+    cron_logger.info("Indexing elapsed({}): {:.2f}".format(r["name"], timer() - st))
+    if es_r:
+        callback(-1, f"Insert chunk error, detail info please check ragflow-logs/api/cron_logger.log. Please also check ES status!")
+        ELASTICSEARCH.deleteByQuery(
+            Q("match", doc_id=r["doc_id"]), idxnm=search.index_name(r["tenant_id"]))
+        cron_logger.error(str(es_r))
+    else:
+        if TaskService.do_cancel(r["id"]):
             ELASTICSEARCH.deleteByQuery(
                 Q("match", doc_id=r["doc_id"]), idxnm=search.index_name(r["tenant_id"]))
-            cron_logger.error(str(es_r))
+            return True
+        callback(1., "Done!")
+        DocumentService.increment_chunk_num(
+            r["doc_id"], r["kb_id"], tk_count, chunk_count, 0)
+        cron_logger.info(
+            "Chunk doc({}), token({}), chunks({}), elapsed:{:.2f}".format(
+                r["id"], tk_count, len(cks), timer() - st))
+    return True
+
+
+def stage_worker(handle_fn, in_queue, out_queue):
+    """Pull tasks off `in_queue`, run one pipeline stage on them and hand them to `out_queue`.
+
+    `out_queue.put` blocks while the next stage is saturated, which is what
+    keeps the number of chunked-but-not-embedded documents in memory bounded.
+    """
+    while True:
+        item = in_queue.get()
+        forward = False
+        try:
+            forward = handle_fn(item)
+        except TaskCanceledException:
+            cron_logger.info("Task {} has been canceled.".format(item["row"]["id"]))
+        except Exception as e:
+            cron_logger.error("{} of task {}: {}".format(handle_fn.__name__, item["row"]["id"], str(e)))
+            traceback.print_exc()
+            # a failed task is never acked without being marked as failed
+            try:
+                item["callback"](-1, str(e))
+            except Exception as ee:
+                cron_logger.error("Failed to report the error of task {}: {}".format(item["row"]["id"], str(ee)))
+        if forward and out_queue is not None:
+            out_queue.put(item)
         else:
-            if TaskService.do_cancel(r["id"]):
-                ELASTICSEARCH.deleteByQuery(
-                    Q("match", doc_id=r["doc_id"]), idxnm=search.index_name(r["tenant_id"]))
-                continue
-            callback(1., "Done!")
-            DocumentService.increment_chunk_num(
-                r["doc_id"], r["kb_id"], tk_count, chunk_count, 0)
-            cron_logger.info(
-                "Chunk doc({}), token({}), chunks({}), elapsed:{:.2f}".format(
-                    r["id"], tk_count, len(cks), timer() - st))
+            item["handle"].done()
+
+
+def main():
+    build_queue = Queue(maxsize=STAGE_QUEUE_SIZE)
+    embedding_queue = Queue(maxsize=STAGE_QUEUE_SIZE)
+    index_queue = Queue(maxsize=STAGE_QUEUE_SIZE)
+    stages = [
+        (do_build, build_queue, embedding_queue, MAX_CONCURRENT_CHUNK_BUILDERS),
+        (do_embedding, embedding_queue, index_queue, MAX_CONCURRENT_EMBEDDINGS),
+        (do_index, index_queue, None, MAX_CONCURRENT_INDEXERS),
+    ]
+    for handle_fn, in_queue, out_queue, workers in stages:
+        for _ in range(max(1, workers)):
+            threading.Thread(target=stage_worker, args=(handle_fn, in_queue, out_queue), daemon=True).start()
+
+    while True:
+        task_limiter.acquire()
+        payload, rows = collect()
+        if len(rows) == 0:
+            if payload:
+                payload.ack()
+            task_limiter.release()
+            continue
+
+        handle = TaskHandle(payload, len(rows))
+        for _, r in rows.iterrows():
+            callback = partial(set_progress, r["id"], r["from_page"], r["to_page"])
+            build_queue.put({"row": r, "handle": handle, "callback": callback, "tk_count": 0})
 
 
 def report_status():
@@ -413,11 +531,10 @@ if __name__ == "__main__":
     peewee_logger.addHandler(database_logger.handlers[0])
     peewee_logger.setLevel(database_logger.level)
 
+    # fork the tokenizer and pdf page workers before any thread is started
+    rag_tokenizer.init_pool()
+    pdf_parser.init_pool()
     exe = ThreadPoolExecutor(max_workers=1)
     exe.submit(report_status)
 
-    while True:
-        main()
-        if PAYLOAD:
-            PAYLOAD.ack()
-            PAYLOAD = None
+    main()
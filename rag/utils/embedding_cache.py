@@ -0,0 +1,195 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import base64
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from cachetools import TTLCache
+
+from api.utils.file_utils import get_home_cache_dir
+from rag import settings
+from rag.utils import singleton
+from rag.utils.redis_conn import REDIS_CONN
+
+
+def content_key(mdl_name, txt):
+    txt = re.sub(r"\s+", " ", txt).strip()
+    return hashlib.sha1((mdl_name + "\x00" + txt).encode("utf-8")).hexdigest()
+
+
+@singleton
+class EmbeddingCache:
+    """
+    Content-addressed cache of embedding vectors keyed by (model, normalized text).
+
+    Lookups go to a local sqlite file first, then to Redis if EMBEDDING_CACHE_REDIS
+    is on. The local tier keeps at most EMBEDDING_CACHE_MAX_ITEMS rows and drops
+    the least recently used ones beyond that; the Redis tier relies on key TTL and
+    the server's maxmemory-policy (allkeys-lru) for eviction.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.conn = None
+        self.inserted = 0
+        try:
+            dir = settings.EMBEDDING_CACHE_DIR if settings.EMBEDDING_CACHE_DIR else get_home_cache_dir()
+            os.makedirs(dir, exist_ok=True)
+            self.conn = sqlite3.connect(os.path.join(dir, "embedding_cache.db"),
+                                        timeout=30, check_same_thread=False, isolation_level=None)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS embd (k TEXT PRIMARY KEY, v BLOB, atime INTEGER)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS embd_atime ON embd(atime)")
+        except Exception as e:
+            logging.warning("Embedding cache is unavailable: " + str(e))
+            self.conn = None
+
+    def get(self, mdl_name, texts):
+        """Return one vector per text, None where the text is not cached."""
+        keys = [content_key(mdl_name, t) for t in texts]
+        res = [None] * len(keys)
+        if self.conn is not None:
+            try:
+                found = {}
+                with self.lock:
+                    for i in range(0, len(keys), 512):
+                        sub = list(set(keys[i: i + 512]))
+                        for k, v in self.conn.execute(
+                                "SELECT k, v FROM embd WHERE k IN (%s)" % ",".join(["?"] * len(sub)), sub):
+                            found[k] = v
+                    if found:
+                        self.conn.executemany("UPDATE embd SET atime=? WHERE k=?",
+                                              [(int(time.time()), k) for k in found.keys()])
+                for i, k in enumerate(keys):
+                    if k in found:
+                        res[i] = np.frombuffer(found[k], dtype=np.float32)
+            except Exception as e:
+                logging.warning("Embedding cache get: " + str(e))
+
+        miss = [i for i, v in enumerate(res) if v is None]
+        if miss and settings.EMBEDDING_CACHE_REDIS and REDIS_CONN.is_alive():
+            try:
+                vals = REDIS_CONN.REDIS.mget(["embd:" + keys[i] for i in miss])
+                back = []
+                for i, v in zip(miss, vals):
+                    if not v:
+                        continue
+                    res[i] = np.frombuffer(base64.b64decode(v), dtype=np.float32)
+                    back.append((keys[i], res[i]))
+                self._put_local(back)
+            except Exception as e:
+                logging.warning("Embedding cache redis get: " + str(e))
+
+        with self.lock:
+            n = len([v for v in res if v is not None])
+            self.hits += n
+            self.misses += len(res) - n
+        return res
+
+    def put(self, mdl_name, texts, vectors):
+        kvs = [(content_key(mdl_name, t), np.asarray(v, dtype=np.float32)) for t, v in zip(texts, vectors)]
+        self._put_local(kvs)
+        if settings.EMBEDDING_CACHE_REDIS and REDIS_CONN.is_alive():
+            try:
+                pipeline = REDIS_CONN.REDIS.pipeline(transaction=False)
+                for k, v in kvs:
+                    pipeline.set("embd:" + k, base64.b64encode(v.tobytes()).decode("ascii"),
+                                 settings.EMBEDDING_CACHE_REDIS_TTL)
+                pipeline.execute()
+            except Exception as e:
+                logging.warning("Embedding cache redis put: " + str(e))
+
+    def _put_local(self, kvs):
+        if self.conn is None or not kvs:
+            return
+        try:
+            now = int(time.time())
+            with self.lock:
+                self.conn.executemany("INSERT OR REPLACE INTO embd (k, v, atime) VALUES (?, ?, ?)",
+                                      [(k, v.tobytes(), now) for k, v in kvs])
+                self.inserted += len(kvs)
+                if self.inserted < 10000:
+                    return
+                self.inserted = 0
+                cnt = self.conn.execute("SELECT COUNT(*) FROM embd").fetchone()[0]
+                if cnt > settings.EMBEDDING_CACHE_MAX_ITEMS:
+                    self.conn.execute("DELETE FROM embd WHERE k IN (SELECT k FROM embd ORDER BY atime LIMIT ?)",
+                                      (cnt - settings.EMBEDDING_CACHE_MAX_ITEMS,))
+        except Exception as e:
+            logging.warning("Embedding cache put: " + str(e))
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / total if total else 0.}
+
+
+@singleton
+class QueryEmbeddingCache:
+    """
+    Query vectors keyed by (model, normalized question), kept in an in-process
+    LRU with TTL and, if QUERY_EMBEDDING_CACHE_REDIS is on, in Redis so that all
+    API workers share them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cache = TTLCache(maxsize=settings.QUERY_EMBEDDING_CACHE_SIZE, ttl=settings.QUERY_EMBEDDING_CACHE_TTL)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, mdl_name, question):
+        k = content_key(mdl_name, question)
+        with self.lock:
+            v = self.cache.get(k)
+        if v is None and settings.QUERY_EMBEDDING_CACHE_REDIS and REDIS_CONN.is_alive():
+            v = REDIS_CONN.get("qembd:" + k)
+            if v:
+                v = np.frombuffer(base64.b64decode(v), dtype=np.float32)
+                with self.lock:
+                    self.cache[k] = v
+        with self.lock:
+            if v is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        # callers may normalize the vector in place
+        return v.copy() if v is not None else None
+
+    def put(self, mdl_name, question, vector):
+        k = content_key(mdl_name, question)
+        v = np.array(vector, dtype=np.float32)
+        with self.lock:
+            self.cache[k] = v
+        if settings.QUERY_EMBEDDING_CACHE_REDIS and REDIS_CONN.is_alive():
+            REDIS_CONN.set("qembd:" + k, base64.b64encode(v.tobytes()).decode("ascii"),
+                           settings.QUERY_EMBEDDING_CACHE_TTL)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.cache),
+                    "hit_rate": self.hits / total if total else 0.}
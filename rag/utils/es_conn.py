@@ -1,9 +1,13 @@
 import re
 import json
+import random
+import threading
 import time
 import copy
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
 
 import elasticsearch
+import numpy as np
 from elastic_transport import ConnectionTimeout
 from elasticsearch import Elasticsearch
 from elasticsearch_dsl import UpdateByQuery, Search, Index
@@ -14,12 +18,24 @@ from rag.utils import singleton
 es_logger.info("Elasticsearch version: "+str(elasticsearch.__version__))
 
 
+def json_default(o):
+    # Vectors are kept as float32 rows until they are written into a request.
+    if isinstance(o, np.ndarray):
+        return o.tolist()
+    if isinstance(o, np.generic):
+        return o.item()
+    raise TypeError("Object of type %s is not JSON serializable" % type(o).__name__)
+
+
 @singleton
 class ESConnection:
     def __init__(self):
         self.info = {}
+        self.conn_lock = threading.Lock()
         self.conn()
         self.idxnm = settings.ES.get("index_name", "")
+        self.bulk_max_bytes = int(settings.ES.get("bulk_max_bytes", 8 * 1024 * 1024))
+        self.bulk_parallelism = int(settings.ES.get("bulk_parallelism", 4))
         if not self.es.ping():
             raise Exception("Can't connect to ES cluster")
 
@@ -40,6 +56,12 @@ class ESConnection:
                 es_logger.error("Fail to connect to es: " + str(e))
                 time.sleep(1)
 
+    def _reconnect(self, failed):
+        # Bulk threads that saw the same client fail reconnect only once.
+        with self.conn_lock:
+            if self.es is failed:
+                self.conn()
+
     def version(self):
         v = self.info.get("version", {"number": "5.6"})
         v = v["number"].split(".")[0]
@@ -104,17 +126,15 @@ class ESConnection:
         return False
 
     def bulk(self, df, idx_nm=None):
-        ids, acts = {}, []
+        acts = []
         for d in df:
             id = d["id"] if "id" in d else d["_id"]
-            ids[id] = copy.deepcopy(d)
-            ids[id]["_index"] = self.idxnm if not idx_nm else idx_nm
             if "id" in d:
                 del d["id"]
             if "_id" in d:
                 del d["_id"]
             acts.append(
-                {"update": {"_id": id, "_index": ids[id]["_index"]}, "retry_on_conflict": 100})
+                {"update": {"_id": id, "_index": self.idxnm if not idx_nm else idx_nm}, "retry_on_conflict": 100})
             acts.append({"doc": d, "doc_as_upsert": "true"})
 
         res = []
@@ -149,6 +169,93 @@ class ESConnection:
 
         return res
 
+    def bulk_index(self, df, idx_nm=None, progress=None):
+        """
+        Index freshly built chunks with plain `index` ops.
+
+        Requests are cut by serialized size (`bulk_max_bytes`) instead of
+        document count and up to `bulk_parallelism` of them are in flight at
+        once. Items rejected with 429 are re-sent on their own with jittered
+        exponential backoff; the rest of the batch is never re-sent.
+        `progress`, if given, is called with the fraction of documents done.
+        Returns "<id>:<error>" for every item that could not be indexed.
+        """
+        idx_nm = idx_nm if idx_nm else self.idxnm
+        parallel = max(1, self.bulk_parallelism)
+        res, total, done = [], len(df), 0
+        futures = {}
+
+        def collect(return_when):
+            nonlocal done
+            finished, _ = wait(futures.keys(), return_when=return_when)
+            for f in finished:
+                res.extend(f.result())
+                done += futures.pop(f)
+                if progress:
+                    progress(done / total)
+
+        # Documents are serialized batch by batch so that only the requests in
+        # flight are held in memory as JSON.
+        with ThreadPoolExecutor(max_workers=parallel) as exe:
+            batch, size = [], 0
+            for i, d in enumerate(df):
+                id = d["id"] if "id" in d else d["_id"]
+                action = json.dumps({"index": {"_index": idx_nm, "_id": id}})
+                source = json.dumps({k: v for k, v in d.items() if k not in ("id", "_id")}, ensure_ascii=False,
+                                    default=json_default)
+                batch.append((id, action, source))
+                size += len(action) + len(source.encode("utf-8")) + 2
+                if size < self.bulk_max_bytes and i + 1 < total:
+                    continue
+                if len(futures) >= parallel:
+                    collect(FIRST_COMPLETED)
+                futures[exe.submit(self._bulk_index_batch, batch, idx_nm)] = len(batch)
+                batch, size = [], 0
+            if futures:
+                collect(ALL_COMPLETED)
+        return res
+
+    def _bulk_index_batch(self, batch, idx_nm):
+        res = []
+        for i in range(10):
+            ops = []
+            for _, action, source in batch:
+                ops.append(action)
+                ops.append(source)
+            es = self.es
+            try:
+                if elasticsearch.__version__[0] < 8:
+                    r = es.bulk(index=idx_nm, body=ops, refresh=False, timeout="600s")
+                else:
+                    r = es.bulk(index=idx_nm, operations=ops, refresh=False, timeout="600s")
+            except Exception as e:
+                es_logger.warning("Fail to bulk: " + str(e))
+                if not re.search(r"(Timeout|time out|429|Too Many Requests)", str(e), re.IGNORECASE):
+                    self._reconnect(es)
+                time.sleep(min(60, 2 ** i) * (0.5 + random.random()))
+                continue
+
+            if not r["errors"]:
+                return res
+            retry = []
+            for b, it in zip(batch, r["items"]):
+                it = it["index"]
+                if "error" not in it:
+                    continue
+                if it.get("status") == 429:
+                    retry.append(b)
+                else:
+                    res.append(str(it["_id"]) + ":" + str(it["error"]))
+            if not retry:
+                return res
+            es_logger.warning("Bulk rejected {}/{} items, retrying.".format(len(retry), len(batch)))
+            batch = retry
+            time.sleep(min(60, 2 ** i) * (0.5 + random.random()))
+
+        for id, _, _ in batch:
+            res.append(str(id) + ":Fail to bulk after retries.")
+        return res
+
     def bulk4script(self, df):
         ids, acts = {}, []
         for d in df:
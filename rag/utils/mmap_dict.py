@@ -0,0 +1,137 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+
+import numpy as np
+
+MAGIC = b"RFMD1\n"
+
+
+def _hash(k):
+    return int.from_bytes(hashlib.blake2b(k, digest_size=8).digest(), "little")
+
+
+class MmapDict:
+    """
+    Read-only str -> int/str mapping kept in a binary file and memory-mapped,
+    so every process on a host shares one copy of it through the page cache.
+
+    Layout after MAGIC: header length (uint32) and JSON header, then sorted
+    uint64 key hashes, uint64 key offsets, int64 values and the UTF-8 keys.
+    String values are stored as indexes into the header's "labels".
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            raise ValueError("Not a dictionary file: " + path)
+        hlen, = struct.unpack_from("<I", self._mm, len(MAGIC))
+        off = len(MAGIC) + 4
+        header = json.loads(self._mm[off:off + hlen])
+        off += hlen + (-(off + hlen) % 8)
+        self._n = n = header["n"]
+        self._labels = header["labels"]
+        self._hashes = np.frombuffer(self._mm, dtype="<u8", count=n, offset=off)
+        self._offsets = np.frombuffer(self._mm, dtype="<u8", count=n + 1, offset=off + 8 * n)
+        self._values = np.frombuffer(self._mm, dtype="<i8", count=n, offset=off + 16 * n + 8)
+        self._keys = off + 24 * n + 8
+
+    @staticmethod
+    def build(path, items):
+        if not isinstance(items, dict):
+            items = dict.fromkeys(items, 0)
+        labels = None
+        if any(isinstance(v, str) for v in items.values()):
+            labels = sorted(set(items.values()))
+            index = {l: i for i, l in enumerate(labels)}
+            items = {k: index[v] for k, v in items.items()}
+
+        keys = [(_hash(k.encode("utf-8")), k.encode("utf-8"), v) for k, v in items.items()]
+        keys.sort(key=lambda x: (x[0], x[1]))
+        header = json.dumps({"n": len(keys), "labels": labels}).encode("utf-8")
+        offsets = np.zeros(len(keys) + 1, dtype="<u8")
+        np.cumsum([len(k) for _, k, _ in keys], out=offsets[1:])
+
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(MAGIC + struct.pack("<I", len(header)) + header)
+            f.write(b"\0" * (-(len(MAGIC) + 4 + len(header)) % 8))
+            f.write(np.array([h for h, _, _ in keys], dtype="<u8").tobytes())
+            f.write(offsets.tobytes())
+            f.write(np.array([v for _, _, v in keys], dtype="<i8").tobytes())
+            for _, k, _ in keys:
+                f.write(k)
+        os.replace(tmp, path)
+
+    @classmethod
+    def open(cls, src, loader):
+        """
+        Map the binary form of `src` (`src`.bin), first building it with
+        `loader(src)` if it is missing or older than `src`. Falls back to
+        the loaded object itself when the binary file cannot be written.
+        """
+        path = src + ".bin"
+        if os.path.exists(src) and (not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(src)):
+            items = loader(src)
+            try:
+                cls.build(path, items)
+            except OSError as e:
+                logging.warning("Can't write %s: %s" % (path, e))
+                return items
+        return cls(path)
+
+    def _find(self, k):
+        kb = k.encode("utf-8")
+        h = np.uint64(_hash(kb))
+        i = int(np.searchsorted(self._hashes, h))
+        while i < self._n and self._hashes[i] == h:
+            s, e = int(self._offsets[i]), int(self._offsets[i + 1])
+            if self._mm[self._keys + s:self._keys + e] == kb:
+                return i
+            i += 1
+        return -1
+
+    def get(self, k, default=None):
+        if not isinstance(k, str):
+            return default
+        i = self._find(k)
+        if i < 0:
+            return default
+        v = int(self._values[i])
+        return self._labels[v] if self._labels is not None else v
+
+    def __getitem__(self, k):
+        v = self.get(k, self)
+        if v is self:
+            raise KeyError(k)
+        return v
+
+    def __contains__(self, k):
+        return isinstance(k, str) and self._find(k) >= 0
+
+    def __len__(self):
+        return self._n
+
+    def __iter__(self):
+        for i in range(self._n):
+            s, e = int(self._offsets[i]), int(self._offsets[i + 1])
+            yield self._mm[self._keys + s:self._keys + e].decode("utf-8")
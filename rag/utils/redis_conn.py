@@ -25,6 +25,9 @@ class Payload:
     def get_message(self):
         return self.__message
 
+    def get_msg_id(self):
+        return self.__msg_id
+
 
 @singleton
 class RedisDB:
@@ -136,6 +139,8 @@ class RedisDB:
             if not messages:
                 return None
             stream, element_list = messages[0]
+            if not element_list:
+                return None
             msg_id, payload = element_list[0]
             res = Payload(self.REDIS, queue_name, group_name, msg_id, payload)
             return res
@@ -163,4 +168,22 @@ class RedisDB:
             logging.warning("[EXCEPTION]xpending_range: " + consumer_name + "||" + str(e))
             self.__open__()
 
+    def get_unacked_iterator(self, queue_name, group_name, consumer_name):
+        try:
+            group_info = self.REDIS.xinfo_groups(queue_name)
+            if not any(e["name"] == group_name for e in group_info):
+                return
+            current_min = 0
+            while True:
+                payload = self.queue_consumer(queue_name, group_name, consumer_name, current_min)
+                if not payload:
+                    return
+                current_min = payload.get_msg_id()
+                yield payload
+        except Exception as e:
+            if 'key' in str(e):
+                return
+            logging.warning("[EXCEPTION]xpending_iterator: " + consumer_name + "||" + str(e))
+            self.__open__()
+
 REDIS_CONN = RedisDB()